@@ -3,11 +3,13 @@ from ella.api.conf import api_settings
 from ella.core.models import Category, Publishable, Listing, Author, Source
 from ella.photos.models import FormatedPhoto, Photo
 from ella.core.conf import core_settings
+from ella.core.cache import prefetch_cached
 
 from django.core.paginator import Page, Paginator
 from django.utils import simplejson
 from django.http import Http404
 from ella.utils.timezone import to_timestamp
+from ella.utils.pagination import CursorPage, is_cursor
 
 
 
@@ -20,19 +22,28 @@ def serialize_dict(request, d):
 
 
 def serialize_page(request, page):
-    return {
+    if page.object_list and isinstance(page.object_list[0], Listing):
+        prefetch_cached(page.object_list, 'publishable__photo', 'publishable__source')
+    data = {
         'total': page.paginator.count,
         'per_page': page.paginator.per_page,
         'num_pages': page.paginator.num_pages,
         'current_page': page.number,
         'objects': serialize_list(request, page.object_list),
     }
+    if isinstance(page, CursorPage):
+        data['next_page'] = page.next_cursor() if page.has_next() else None
+        data['previous_page'] = page.previous_cursor() if page.has_previous() else None
+    return data
 
 
 def serialize_full_category(request, category):
     page_no = 1
-    if 'p' in request.GET and request.GET['p'].isdigit():
-        page_no = int(request.GET['p'])
+    if 'p' in request.GET:
+        if is_cursor(request.GET['p']):
+            page_no = request.GET['p']
+        elif request.GET['p'].isdigit():
+            page_no = int(request.GET['p'])
     return object_serializer.serialize(request, {'category': category, 'listings': category.app_data.ella.get_listings_page(page_no)})
 
 
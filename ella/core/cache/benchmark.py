@@ -0,0 +1,89 @@
+"""
+Micro benchmarks of the object cache run against objects in the database,
+use ``manage.py benchmark_cache`` to run them.
+"""
+import time
+import cPickle as pickle
+
+from django.db import connection
+from django.db.models.loading import get_model
+from django.contrib.contenttypes.models import ContentType
+
+from ella.core.cache import utils
+from ella.core.cache.serializers import PickleSerializer, RowSerializer
+
+
+def _timeit(func, number):
+    start = time.time()
+    for i in xrange(number):
+        func()
+    return (time.time() - start) / number
+
+
+def _count_queries(func):
+    old = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        func()
+    finally:
+        connection.use_debug_cursor = old
+    return len(connection.queries) - start
+
+
+def benchmark_serializers(number=1000, models=('articles.article', 'core.category', 'photos.photo')):
+    """
+    Compare the size of the cached value and the time it takes to load it
+    for the first instance of each model using every serializer.
+    """
+    results = []
+    for model_name in models:
+        model = get_model(*model_name.split('.'))
+        try:
+            obj = model._default_manager.all()[0]
+        except IndexError:
+            continue
+
+        for serializer in (PickleSerializer(), RowSerializer()):
+            data = pickle.dumps(serializer.dumps(obj), pickle.HIGHEST_PROTOCOL)
+            decode = _timeit(lambda: serializer.loads(pickle.loads(data)), number)
+            results.append((model_name, serializer.__class__.__name__, len(data), '%.1f' % (decode * 10 ** 6)))
+    return results
+
+
+def benchmark_publishables(number=1000, count=20):
+    """
+    Number of queries and time it takes to fetch ``count`` most recent
+    publishables of mixed content types none of which is in cache, first
+    with their content types unknown and then with the content types already
+    remembered.
+    """
+    Publishable = get_model('core', 'publishable')
+    pks = list(Publishable.objects.order_by('-publish_from').values_list('id', flat=True)[:count])
+    if not pks:
+        return []
+    ct = ContentType.objects.get_for_model(Publishable)
+    keys = lambda: utils._get_keys(utils.KEY_PREFIX, [(ct, pk) for pk in pks])
+    fetch = lambda: utils.get_cached_objects(pks, Publishable, missing=utils.SKIP)
+    types = len(set(Publishable.objects.filter(pk__in=pks).values_list('content_type_id', flat=True)))
+
+    def cold():
+        utils.cache.delete_many(keys() + [utils._get_publishable_type_key(pk) for pk in pks])
+        utils.local_cache.clear()
+        fetch()
+
+    def types_known():
+        utils.cache.delete_many(keys())
+        fetch()
+
+    results = []
+    for name, func in (('cold', cold), ('types known', types_known)):
+        func()
+        results.append((name, len(pks), types, _count_queries(func), '%.1f' % (_timeit(func, number) * 10 ** 3)))
+    return results
+
+
+BENCHMARKS = {
+    'serializers': (benchmark_serializers, ('model', 'serializer', 'size (B)', 'decode (us)')),
+    'publishables': (benchmark_publishables, ('cache', 'objects', 'content types', 'queries', 'time (ms)')),
+}
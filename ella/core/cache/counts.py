@@ -0,0 +1,219 @@
+"""
+Number of listings in a category kept in the cache for
+``ModelListingHandler.count``. Every ``(category, children, content_type)``
+combination is counted separately, the counts are adjusted as listings get
+saved or deleted and publishables change their ``published`` flag. They are
+recounted once they expire after ``LISTING_COUNT_TIMEOUT`` or when the next
+listing within the combination is scheduled to go live or expire, whichever
+comes first.
+"""
+from django.core.cache import cache
+from django.db.models import Min
+from django.db.models.loading import get_model
+
+from ella.core.conf import core_settings
+from ella.core.managers import ListingHandler
+from ella.utils import timezone
+from ella.utils.timezone import to_timestamp
+
+KEY_PREFIX = 'core.listing_count'
+
+
+def _get_count_key(category_id, children, ct_id):
+    return '%s:%s:%d:%s' % (KEY_PREFIX, category_id or '', children, ct_id or '')
+
+
+def get_listing_count(category, children, content_types=()):
+    """
+    Return the number of listings ``get_listing_queryset`` would return for
+    given arguments, counting only the combinations missing in the cache.
+    """
+    Listing = get_model('core', 'listing')
+
+    if category is None:
+        children = ListingHandler.NONE
+
+    # every publishable has exactly one content type
+    ct_ids = [ct.pk for ct in content_types] or [None]
+    keys = dict((_get_count_key(category and category.pk, children, ct_id), ct_id) for ct_id in ct_ids)
+    counts = cache.get_many(keys.keys())
+
+    for key, ct_id in keys.items():
+        if key not in counts:
+            counts[key] = Listing.objects.get_listing_queryset(
+                    category,
+                    children=children,
+                    content_types=[ct_id] if ct_id else []
+                ).count()
+            cache.set(key, counts[key], _get_count_timeout(category, children, ct_id))
+    return sum(counts.values())
+
+
+def _get_count_timeout(category, children, ct_id):
+    """
+    Seconds until a listing counted for given arguments is scheduled to go
+    live or expire, ``LISTING_COUNT_TIMEOUT`` at most.
+    """
+    Listing = get_model('core', 'listing')
+    n = timezone.now()
+
+    qset = Listing.objects.filter(publishable__published=True)
+    if category is not None:
+        if children == ListingHandler.NONE:
+            qset = qset.filter(category=category)
+        else:
+            max_depth = 1 if children == ListingHandler.IMMEDIATE else None
+            qset = qset.filter(category__in=Listing.objects._get_descendants(category, max_depth))
+    if ct_id:
+        qset = qset.filter(publishable__content_type=ct_id)
+
+    timeout = core_settings.LISTING_COUNT_TIMEOUT
+    for field in ('publish_from', 'publish_to'):
+        upcoming = qset.filter(**{field + '__gt': n}).aggregate(upcoming=Min(field))['upcoming']
+        if upcoming is not None:
+            timeout = min(timeout, max(1, int(to_timestamp(upcoming) - to_timestamp(n)) + 1))
+    return timeout
+
+
+def get_category_scopes(category):
+    """
+    Return ``(category_id, children)`` pairs of all the listings a listing
+    in ``category`` shows up in. Mirrors ``get_listing_queryset``.
+    """
+    CategoryClosure = get_model('core', 'categoryclosure')
+
+    scopes = set([
+        (None, ListingHandler.NONE),
+        (category.pk, ListingHandler.NONE),
+        (category.pk, ListingHandler.IMMEDIATE),
+        (category.pk, ListingHandler.ALL),
+    ])
+    ancestors = CategoryClosure.objects.get_propagated(category)
+    if ancestors:
+        scopes.add((ancestors[0], ListingHandler.IMMEDIATE))
+        scopes.update((a, ListingHandler.ALL) for a in ancestors)
+    return scopes
+
+
+def _get_live_listings(publishable, exclude_pk=None):
+    Listing = get_model('core', 'listing')
+    n = timezone.now()
+    qset = Listing.objects.filter(publishable=publishable, publish_from__lte=n).exclude(publish_to__lt=n)
+    if exclude_pk:
+        qset = qset.exclude(pk=exclude_pk)
+    return list(qset.select_related('category'))
+
+
+def _is_live(listing):
+    n = timezone.now()
+    return listing.publish_from <= n and not (listing.publish_to and listing.publish_to < n)
+
+
+def adjust_listing_counts(categories, publishable, delta, others=()):
+    """
+    Add ``delta`` to the counts of all listings containing ``publishable``
+    listed once in every one of ``categories``. Counts with children list
+    every publishable only once, those it is also in through its remaining
+    listings in ``others`` are left alone. Counts without children count
+    every listing.
+    """
+    listings = {}
+    distinct = set()
+    for c in categories:
+        for scope in get_category_scopes(c):
+            if scope[1] == ListingHandler.NONE:
+                listings[scope] = listings.get(scope, 0) + delta
+            else:
+                distinct.add(scope)
+    for c in others:
+        distinct.difference_update(get_category_scopes(c))
+    listings.update((scope, delta) for scope in distinct)
+
+    for (category_id, children), d in listings.items():
+        for ct_id in (None, publishable.content_type_id):
+            try:
+                cache.incr(_get_count_key(category_id, children, ct_id), d)
+            except ValueError:
+                # not counted yet
+                pass
+
+
+def listing_pre_save(sender, instance, **kwargs):
+    if instance.pk:
+        try:
+            instance._old_listing = sender.objects.get(pk=instance.pk)
+        except sender.DoesNotExist:
+            pass
+
+
+def listing_post_save(sender, instance, **kwargs):
+    old = getattr(instance, '_old_listing', None)
+    instance._old_listing = None
+
+    was_live = old is not None and old.publishable.published and _is_live(old)
+    is_live = instance.publishable.published and _is_live(instance)
+    if was_live and is_live and old.category_id == instance.category_id and old.publishable_id == instance.publishable_id:
+        return
+
+    if was_live:
+        others = [l.category for l in _get_live_listings(old.publishable, instance.pk)]
+        adjust_listing_counts([old.category], old.publishable, -1, others)
+    if is_live:
+        others = [l.category for l in _get_live_listings(instance.publishable, instance.pk)]
+        adjust_listing_counts([instance.category], instance.publishable, 1, others)
+
+
+def listing_post_delete(sender, instance, **kwargs):
+    Publishable = get_model('core', 'publishable')
+    # the whole publishable is being deleted, see publishable_pre_delete
+    if not Publishable.objects.filter(pk=instance.publishable_id).exists():
+        return
+
+    if not (instance.publishable.published and _is_live(instance)):
+        return
+
+    others = [l.category for l in _get_live_listings(instance.publishable)]
+    adjust_listing_counts([instance.category], instance.publishable, -1, others)
+
+
+def publishable_pre_save(sender, instance, **kwargs):
+    Publishable = get_model('core', 'publishable')
+    if not isinstance(instance, Publishable) or not instance.pk:
+        return
+    instance._old_published = list(Publishable.objects.filter(pk=instance.pk).values_list('published', flat=True))
+
+
+def publishable_post_save(sender, instance, **kwargs):
+    old_published = getattr(instance, '_old_published', None)
+    instance._old_published = None
+    # only the published flag changes what get_listing_queryset returns,
+    # publish signals can be sent repeatedly and must not be counted
+    if not old_published or old_published[0] == instance.published:
+        return
+
+    categories = [l.category for l in _get_live_listings(instance)]
+    adjust_listing_counts(categories, instance, 1 if instance.published else -1)
+
+
+def publishable_pre_delete(sender, instance, **kwargs):
+    # remove all listings at once while they are still in the database
+    if instance.published:
+        categories = [l.category for l in _get_live_listings(instance)]
+        adjust_listing_counts(categories, instance, -1)
+
+
+def connect_signals():
+    from django.db.models.signals import pre_save, post_save, post_delete, pre_delete
+    from ella.core.models import Listing, Publishable
+
+    if not core_settings.LISTING_COUNT_TIMEOUT:
+        return
+
+    # sent with the concrete subclasses as sender
+    pre_save.connect(publishable_pre_save)
+    post_save.connect(publishable_post_save)
+    pre_delete.connect(publishable_pre_delete, sender=Publishable)
+
+    pre_save.connect(listing_pre_save, sender=Listing)
+    post_save.connect(listing_post_save, sender=Listing)
+    post_delete.connect(listing_post_delete, sender=Listing)
@@ -4,7 +4,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.sites.models import SITE_CACHE, Site
 
-from ella.core.cache.utils import get_cached_object
+from ella.core.cache.utils import get_cached_object, get_cached_objects, NONE
 
 def generate_fk_class(name, retrieve_func, limit_to_model=None):
     class CustomForeignKey(ForeignKey):
@@ -45,6 +45,52 @@ def generate_fk_class(name, retrieve_func, limit_to_model=None):
 
 CachedForeignKey = generate_fk_class('CachedForeignKey', lambda m, pk: get_cached_object(m, pk=pk))
 
+def prefetch_cached(objects, *fields):
+    """
+    Resolve ``CachedForeignKey`` ``fields`` on all ``objects`` at once using a
+    single ``get_cached_objects`` call per field and store the related
+    objects on the instances. Relations can be followed using ``__``::
+
+        prefetch_cached(listings, 'publishable', 'publishable__photo')
+
+    Other relations are resolved one by one using the regular descriptors.
+    """
+    for field in fields:
+        _prefetch_cached(list(objects), field.split('__'))
+
+
+def _prefetch_cached(objects, path):
+    objects = [o for o in objects if o is not None]
+    if not objects:
+        return
+
+    name = path[0]
+    field = objects[0]._meta.get_field(name)
+    cache_name = field.get_cache_name()
+
+    if isinstance(field, CachedForeignKey):
+        # group the instances by the related object's pk
+        to_get = {}
+        for o in objects:
+            if hasattr(o, cache_name):
+                continue
+            pk = getattr(o, field.attname)
+            if pk is not None:
+                to_get.setdefault(pk, []).append(o)
+
+        if to_get:
+            pks = to_get.keys()
+            for pk, rel_obj in zip(pks, get_cached_objects(pks, model=field.rel.to, missing=NONE)):
+                # leave the missing ones for the descriptor to deal with
+                if rel_obj is None:
+                    continue
+                for o in to_get[pk]:
+                    setattr(o, cache_name, rel_obj)
+
+    if len(path) > 1:
+        _prefetch_cached([getattr(o, name) for o in objects if getattr(o, field.attname) is not None], path[1:])
+
+
 def get_site(model, pk):
     try:
         return SITE_CACHE[pk]
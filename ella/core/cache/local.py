@@ -0,0 +1,70 @@
+import time
+from threading import Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+class LocalCache(object):
+    """
+    Bounded, process-local LRU cache with a timeout on every item. Once
+    ``size`` items are stored, the least recently used ones are evicted.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def _get(self, key, now):
+        try:
+            expires, value = self._data.pop(key)
+        except KeyError:
+            return None
+        if expires <= now:
+            return None
+        # re-insert the item to mark it as most recently used
+        self._data[key] = (expires, value)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key, time.time())
+        if value is None:
+            return default
+        return value
+
+    def get_many(self, keys):
+        out = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    out[key] = value
+        return out
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout=None):
+        expires = time.time() + (self.timeout if timeout is None else timeout)
+        with self._lock:
+            for key, value in data.iteritems():
+                self._data.pop(key, None)
+                self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                del self._data[iter(self._data).next()]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -1,16 +1,23 @@
 from __future__ import absolute_import
 
+import atexit
+import json
 import logging
+import re
 from datetime import date, timedelta
 from hashlib import md5
 from itertools import chain
+from threading import Lock, Timer
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.loading import get_model
 
 from ella.core.cache.utils import get_cached_objects, SKIP
+from ella.core.cache.fields import prefetch_cached
 from ella.core.managers import ListingHandler
 from ella.core.conf import core_settings
+from ella.utils import timezone
 from ella.utils.timezone import now, to_timestamp, from_timestamp
 
 log = logging.getLogger('ella.core')
@@ -26,12 +33,209 @@ if hasattr(settings, 'LISTINGS_REDIS'):
     else:
         client = Redis(**getattr(settings, 'LISTINGS_REDIS'))
 
+# KEYS: listing key, time index key (or the listing key), result key, two
+#       scratch keys for the result, dependency keys of the listing and time
+#       index keys, content type keys
+# ARGV: definition of the result, its timeout, excluded value, time range
+#       (or ''), score range, offset and count
+#
+# Intersects the listing key with the union of the content type keys and the
+# time range from the time index, storing the result in the result key unless
+# it already exists. Returns the total number of items within the score range
+# and the requested page of values with scores, both without the excluded
+# value. The exclusion is done while reading so that every detail page
+# doesn't need its own copy of the listing.
+LISTING_SCRIPT = """
+local base, time_key, result, tmp_ct, tmp_time = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local base_deps, time_deps = KEYS[6], KEYS[7]
+local definition, ttl, exclude, tmin, tmax = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5]
+local min, max = ARGV[6], ARGV[7]
+local offset, count = tonumber(ARGV[8]), tonumber(ARGV[9])
+
+local source = base
+if #KEYS > 7 or tmin ~= '' then
+    source = result
+    if redis.call('EXISTS', result) == 0 then
+        redis.call('ZUNIONSTORE', result, 1, base)
+        if #KEYS > 7 then
+            redis.call('ZUNIONSTORE', tmp_ct, #KEYS - 7, unpack(KEYS, 8))
+            redis.call('ZINTERSTORE', result, 2, result, tmp_ct, 'WEIGHTS', 1, 0)
+            redis.call('DEL', tmp_ct)
+        end
+        if tmin ~= '' then
+            redis.call('ZUNIONSTORE', tmp_time, 1, time_key)
+            redis.call('ZREMRANGEBYSCORE', tmp_time, '-inf', '(' .. tmin)
+            redis.call('ZREMRANGEBYSCORE', tmp_time, '(' .. tmax, '+inf')
+            redis.call('ZINTERSTORE', result, 2, result, tmp_time, 'WEIGHTS', 1, 0)
+            redis.call('DEL', tmp_time)
+        end
+        redis.call('EXPIRE', result, ttl)
+
+        -- remember how to maintain the result, see refresh_materialized;
+        -- content type keys only change along with the listing keys
+        for _, deps in ipairs({base_deps, time_deps}) do
+            redis.call('HSET', deps, result, definition)
+            redis.call('EXPIRE', deps, ttl)
+        end
+    end
+end
+
+local unbounded = min == '-inf' and max == '+inf'
+
+-- is the excluded value within the range and does it precede the page?
+local excluded, skip = 0, 0
+if exclude ~= '' then
+    local score = redis.call('ZSCORE', source, exclude)
+    if score and (min == '-inf' or tonumber(score) >= tonumber(min)) and (max == '+inf' or tonumber(score) <= tonumber(max)) then
+        excluded = 1
+        local rank = redis.call('ZREVRANK', source, exclude)
+        if max ~= '+inf' then
+            rank = rank - redis.call('ZCOUNT', source, '(' .. max, '+inf')
+        end
+        if rank < offset then
+            skip = 1
+        end
+    end
+end
+
+local total, page
+offset = offset + skip
+if unbounded then
+    total = redis.call('ZCARD', source)
+    page = count > 0 and redis.call('ZREVRANGE', source, offset, offset + count + excluded - 1, 'WITHSCORES') or {}
+else
+    total = redis.call('ZCOUNT', source, min, max)
+    page = count > 0 and redis.call('ZREVRANGEBYSCORE', source, max, min, 'WITHSCORES', 'LIMIT', offset, count + excluded) or {}
+end
+
+if excluded == 1 then
+    local out = {}
+    for i = 1, #page, 2 do
+        if page[i] ~= exclude and #out < count * 2 then
+            table.insert(out, page[i])
+            table.insert(out, page[i + 1])
+        end
+    end
+    page = out
+end
+return {total - excluded, page}
+"""
+
+# KEYS: result key, dependency key it was found in, listing key, time index
+#       key (or the listing key), content type keys
+# ARGV: value added, removed or rescored, time range (or '')
+#
+# Updates the value in an existing result of LISTING_SCRIPT or forgets the
+# result if it has expired meanwhile.
+REFRESH_SCRIPT = """
+local result, deps, base, time_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local value, tmin, tmax = ARGV[1], ARGV[2], ARGV[3]
+
+if redis.call('EXISTS', result) == 0 then
+    redis.call('HDEL', deps, result)
+    return
+end
+
+local score = redis.call('ZSCORE', base, value)
+if score and #KEYS > 4 then
+    local found = false
+    for i = 5, #KEYS do
+        if redis.call('ZSCORE', KEYS[i], value) then
+            found = true
+            break
+        end
+    end
+    score = found and score
+end
+if score and tmin ~= '' then
+    local t = redis.call('ZSCORE', time_key, value)
+    if not t or tonumber(t) < tonumber(tmin) or tonumber(t) > tonumber(tmax) then
+        score = false
+    end
+end
+
+if score then
+    redis.call('ZADD', result, score, value)
+else
+    redis.call('ZREM', result, value)
+end
+"""
+
+listing_script = client.register_script(LISTING_SCRIPT) if client else None
+refresh_script = client.register_script(REFRESH_SCRIPT) if client else None
+
+
+def refresh_materialized(pipe, keys, value=''):
+    """
+    Note that results of ``LISTING_SCRIPT`` based on ``keys`` have to be
+    updated once ``value`` has been modified in them, or dropped if
+    ``value`` is empty because the keys have been rebuilt completely. The
+    updates are queued by ``execute_pipeline``.
+    """
+    if keys:
+        if not hasattr(pipe, 'materialized'):
+            pipe.materialized = []
+        pipe.materialized.append((list(keys), value))
+
+
+def execute_pipeline(pipe):
+    """
+    Execute ``pipe`` along with the updates of materialized results noted
+    by ``refresh_materialized``. The results depending on all the modified
+    keys are looked up in a single round trip beforehand, a result created
+    meanwhile can miss the change until it expires after
+    ``RedisListingHandler.RESULT_TIMEOUT``.
+    """
+    pending = getattr(pipe, 'materialized', [])
+    pipe.materialized = []
+
+    if pending:
+        deps = sorted(set(k + ':deps' for keys, value in pending for k in keys))
+        lookup = client.pipeline(transaction=False)
+        for d in deps:
+            lookup.hgetall(d)
+        dependent = dict(zip(deps, lookup.execute()))
+
+        for keys, value in pending:
+            for k in keys:
+                d = k + ':deps'
+                results = dependent[d]
+                if not results:
+                    continue
+                if not value:
+                    pipe.delete(d, *results.keys())
+                    continue
+                for result, definition in results.iteritems():
+                    result_keys, tmin, tmax = json.loads(definition)
+                    refresh_script(keys=[result, d] + result_keys, args=[value, tmin, tmax], client=pipe)
+
+    return pipe.execute()
 
 
 def ListingHandlerClass():
     return get_model('core', 'Listing').objects.get_listing_handler(core_settings.REDIS_LISTING_HANDLER)
 
 
+def get_category_key_parts(category):
+    """
+    Return parts of keys (without prefix) of the category itself and of its
+    ancestors the listings propagate to, taken from the category closure.
+    """
+    cid = str(category.pk)
+    # main category
+    own = [(cid, ), ('c', cid), ('d', cid)]
+    propagated = []
+
+    ancestors = get_model('core', 'CategoryClosure').objects.get_propagated(category)
+    if ancestors:
+        # children
+        propagated.append(('c', str(ancestors[0])))
+        # all children
+        propagated.extend(('d', str(a)) for a in ancestors)
+
+    return own, propagated
+
+
 def publishable_published(publishable, **kwargs):
     pipe = client.pipeline()
     listings = publishable.listing_set.all()
@@ -48,7 +252,7 @@ def publishable_published(publishable, **kwargs):
     if len(listings) > 0:
         AuthorListingHandler.add_publishable(publishable, pipe=pipe, commit=False)
 
-    pipe.execute()
+    ListingHandlerClass().execute(pipe)
 
 
 def publishable_unpublished(publishable, **kwargs):
@@ -62,7 +266,7 @@ def publishable_unpublished(publishable, **kwargs):
         )
 
     AuthorListingHandler.remove_publishable(publishable, pipe=pipe, commit=False)
-    pipe.execute()
+    ListingHandlerClass().execute(pipe)
 
 
 def listing_pre_delete(sender, instance, **kwargs):
@@ -93,7 +297,7 @@ def listing_post_delete(sender, instance, **kwargs):
     if not listings.exists():
         AuthorListingHandler.remove_publishable(instance.publishable, pipe=pipe,
                                                 commit=False)
-    pipe.execute()
+    ListingHandlerClass().execute(pipe)
 
 
 def listing_pre_save(sender, instance, **kwargs):
@@ -124,7 +328,7 @@ def listing_post_save(sender, instance, **kwargs):
             AuthorListingHandler.add_publishable(instance.publishable, pipe=pipe,
                                                  commit=False)
 
-        pipe.execute()
+        ListingHandlerClass().execute(pipe)
 
 
 def update_authors(sender, action, instance, reverse, model, pk_set, **kwargs):
@@ -136,47 +340,66 @@ def update_authors(sender, action, instance, reverse, model, pk_set, **kwargs):
 class RedisListingHandler(ListingHandler):
     PREFIX = 'listing'
 
+    # scores are timestamps of publish_from, if not, a parallel set of keys
+    # scored by publish_from is maintained to serve date ranges
+    TIME_SCORED = False
+
+    # how long are the intersections of keys kept to be reused
+    RESULT_TIMEOUT = 60
+
     @classmethod
     def get_value(cls, publishable):
         return ':'.join((str(publishable.content_type_id), str(publishable.pk)))
 
     @classmethod
-    def get_keys(cls, category, publishable):
-        # main category
-        keys = [':'.join((cls.PREFIX, str(category.id)))]
-        keys.append(':'.join((cls.PREFIX, 'c', str(category.id))))
-        keys.append(':'.join((cls.PREFIX, 'd', str(category.id))))
+    def time_prefix(cls):
+        return ':'.join((cls.PREFIX, 'time'))
 
-        # content_type
-        keys.append(':'.join((cls.PREFIX, 'ct', str(publishable.content_type_id))))
+    @classmethod
+    def get_keys(cls, category, publishable):
+        return cls._get_keys(cls.PREFIX, category, publishable)
 
-        # category shouldn't be propagated
-        if not category.app_data.ella.propagate_listings:
-            return keys
+    @classmethod
+    def get_time_keys(cls, category, publishable):
+        if cls.TIME_SCORED:
+            return []
+        return cls._get_keys(cls.time_prefix(), category, publishable)
 
-        # children
-        if category.tree_parent_id:
-            keys.append(':'.join((cls.PREFIX, 'c', str(category.tree_parent_id))))
+    @classmethod
+    def _get_keys(cls, prefix, category, publishable):
+        own, propagated = get_category_key_parts(category)
+        keys = [':'.join((prefix, ) + parts) for parts in own]
 
-        # all children
-        while category.tree_parent_id:
-            category = category.tree_parent
-            keys.append(':'.join((cls.PREFIX, 'd', str(category.id))))
-            if not category.app_data.ella.propagate_listings:
-                break
+        # content_type
+        keys.append(':'.join((prefix, 'ct', str(publishable.content_type_id))))
 
+        keys.extend(':'.join((prefix, ) + parts) for parts in propagated)
         return keys
 
     @classmethod
-    def add_publishable(cls, category, publishable, score, pipe=None, commit=True):
+    def add_publishable(cls, category, publishable, score=None, publish_from=None, pipe=None, commit=True):
+        """
+        Add publishable with given score to all relevant keys. When no score
+        is given, only the time index is updated, the publishable will appear
+        in the listings once its score is increased via ``incr_score``.
+        """
         if pipe is None:
             pipe = client.pipeline()
 
-        for k in cls.get_keys(category, publishable):
-            pipe.zadd(k, cls.get_value(publishable), score)
+        v = cls.get_value(publishable)
+        if score is not None:
+            for k in cls.get_keys(category, publishable):
+                pipe.zadd(k, v, score)
+
+        time_keys = cls.get_time_keys(category, publishable)
+        time_score = repr(to_timestamp(publish_from or publishable.publish_from))
+        for k in time_keys:
+            pipe.zadd(k, v, time_score)
+
+        refresh_materialized(pipe, cls.get_keys(category, publishable) + time_keys, v)
 
         if commit:
-            pipe.execute()
+            cls.execute(pipe)
         else:
             return pipe
 
@@ -188,9 +411,11 @@ class RedisListingHandler(ListingHandler):
         v = cls.get_value(publishable)
         for k in cls.get_keys(category, publishable):
             pipe.zincrby(k, v, incr_by)
+        # scores change with every hit, materialized results are left to
+        # expire after RESULT_TIMEOUT instead of being refreshed
 
         if commit:
-            pipe.execute()
+            cls.execute(pipe)
         else:
             return pipe
 
@@ -199,60 +424,46 @@ class RedisListingHandler(ListingHandler):
         if pipe is None:
             pipe = client.pipeline()
 
-        for k in cls.get_keys(category, publishable):
-            pipe.zrem(k, cls.get_value(publishable))
+        keys = cls.get_keys(category, publishable) + cls.get_time_keys(category, publishable)
+        v = cls.get_value(publishable)
+        for k in keys:
+            pipe.zrem(k, v)
+        refresh_materialized(pipe, keys, v)
 
         if commit:
-            pipe.execute()
+            cls.execute(pipe)
         else:
             return pipe
 
+    @classmethod
+    def execute(cls, pipe):
+        """
+        Execute ``pipe`` filled by ``add_publishable``, ``incr_score`` or
+        ``remove_publishable`` called with ``commit=False``.
+        """
+        return execute_pipeline(pipe)
+
     def count(self):
-        key, pipe = self._get_key()
-        if pipe is None:
-            pipe = client.pipeline()
-        pipe = pipe.zcard(key)
-        results = pipe.execute()
-        return results[-1]
+        return self._query(0, 0)[0]
 
     def _get_listing(self, publishable, score):
         Listing = get_model('core', 'listing')
         return Listing(publishable=publishable, category=publishable.category)
 
     def _get_score_limits(self):
-        max_score = None
-        min_score = None
-
-        if self.date_range:
-            raise NotImplemented()
-        return min_score, max_score
+        # date range is applied in the listing script via the time index
+        return None, None
 
     def get_listings(self, offset=0, count=10):
-        key, pipe = self._get_key()
-        if pipe is None:
-            pipe = client.pipeline()
+        return self.get_page(offset, count)[0]
 
-        # get the score range based on the date range
-        min_score, max_score = self._get_score_limits()
-
-        # get all the relevant records
-        if min_score or max_score:
-            pipe = pipe.zrevrangebyscore(key,
-                max_score, min_score,
-                start=offset, num=count,
-                withscores=True
-            )
-        else:
-            pipe = pipe.zrevrange(key,
-                start=offset, end=offset + count - 1,
-                withscores=True
-            )
-        results = pipe.execute()
+    def get_page(self, offset=0, count=10):
+        total, results = self._query(offset, count)
 
         # get the data from redis into proper format
         data = []
         ids = []
-        for value, score in results[-1]:
+        for value, score in results:
             ct_id, pk = value.split(':')
             ids.append((int(ct_id), int(pk)))
             data.append(score)
@@ -261,19 +472,27 @@ class RedisListingHandler(ListingHandler):
         publishables = get_cached_objects(ids, missing=SKIP)
 
         # create mock Listing objects to return
-        return map(lambda (p, score): self._get_listing(p, score), zip(publishables, data))
-
-    def _union(self, union_keys, pipe):
-        if len(union_keys) > 1:
-            result_key = '%s:zus:%s' % (self.PREFIX, md5(','.join(union_keys)).hexdigest())
-            pipe.zunionstore(result_key, union_keys, 'MAX')
-            pipe.expire(result_key, 60)
-            return result_key
-        else:
-            return union_keys[0]
-
-    def _get_base_key(self):
-        key_parts = [self.PREFIX]
+        listings = map(lambda (p, score): self._get_listing(p, score), zip(publishables, data))
+        prefetch_cached(listings, *self.PREFETCH_CACHED)
+        return listings, total
+
+    def _query(self, offset, count):
+        """
+        Run ``LISTING_SCRIPT`` returning the total number of listings and
+        ``count`` (value, score) pairs starting at ``offset``.
+        """
+        keys, args = self._get_query()
+        min_score, max_score = self._get_score_limits()
+        args += [
+            '-inf' if min_score is None else min_score,
+            '+inf' if max_score is None else max_score,
+            offset, count
+        ]
+        total, page = listing_script(keys=keys, args=args)
+        return total, [(page[i], float(page[i + 1])) for i in xrange(0, len(page), 2)]
+
+    def _get_base_key(self, prefix=None):
+        key_parts = [prefix or self.PREFIX]
         # get the proper key for category
         if self.children == ListingHandler.IMMEDIATE:
             key_parts.append('c')
@@ -284,43 +503,42 @@ class RedisListingHandler(ListingHandler):
         key = ':'.join(key_parts)
         return key
 
-
-    def _get_key(self):
-        pipe = None
-        if not hasattr(self, '_key'):
+    def _get_query(self):
+        """
+        Keys and arguments for ``LISTING_SCRIPT`` without the score limits
+        and pagination.
+        """
+        if not hasattr(self, '_query_args'):
             key = self._get_base_key()
-            # do everything in one pipeline
-            pipe = client.pipeline()
-
-            # store all the key sets we will want to ZUNIONSTORE
-            ct_key = None
-            if self.content_types:
-                # get the union of all content_type listings
-                ct_key = self._union([':'.join((self.PREFIX, 'ct', str(ct.pk))) for ct in self.content_types], pipe)
+            keys = [key, key]
+            tmin = tmax = exclude = ''
 
+            if self.date_range and not self.TIME_SCORED:
+                keys[1] = self._get_base_key(self.time_prefix())
+                tmin = repr(to_timestamp(self.date_range[0]))
+                tmax = repr(to_timestamp(self.date_range[1]))
 
-            # do the intersect if required and output a single key
-            if ct_key:
-                inter_key = '%s:zis:%s' % (self.PREFIX, md5(','.join((ct_key, key))).hexdigest())
-                pipe.zinterstore(inter_key, (ct_key, key), 'MAX')
-                pipe.expire(inter_key, 60)
-                key = inter_key
+            if self.content_types:
+                keys.extend(':'.join((self.PREFIX, 'ct', str(ct.pk))) for ct in self.content_types)
 
             if self.exclude:
-                v = '%d:%d' % (self.exclude.content_type_id, self.exclude.id)
+                exclude = '%d:%d' % (self.exclude.content_type_id, self.exclude.id)
 
-                # we are using some existing key, copy it before removing stuff
-                exclude_key = '%s:exclude:%s' % (key, v)
-                pipe.zunionstore(exclude_key, (key,))
-                pipe.zrem(exclude_key, v)
-                pipe.expire(exclude_key, 60)
-                key = exclude_key
-
-            self._key = key
-        return self._key, pipe
+            # materialized result, shared by all handlers with the same filters
+            result_key = '%s:q:%s' % (self.PREFIX, md5(','.join(keys + [tmin, tmax])).hexdigest())
+            definition = json.dumps([keys, tmin, tmax])
+            keys[2:2] = [
+                result_key, result_key + ':ct', result_key + ':time',
+                keys[0] + ':deps', keys[1] + ':deps'
+            ]
+            self._query_args = keys, [definition, self.RESULT_TIMEOUT, exclude, tmin, tmax]
+        keys, args = self._query_args
+        return keys, list(args)
 
 
 class TimeBasedListingHandler(RedisListingHandler):
+    TIME_SCORED = True
+
     @classmethod
     def add_publishable(cls, category, publishable, score=None, publish_from=None, pipe=None, commit=True):
         if score is None:
@@ -348,11 +566,14 @@ class AuthorListingHandler(TimeBasedListingHandler):
         if pipe is None:
             pipe = client.pipeline()
 
-        for k in cls.get_keys(publishable):
-            pipe.zrem(k, cls.get_value(publishable))
+        keys = cls.get_keys(publishable)
+        v = cls.get_value(publishable)
+        for k in keys:
+            pipe.zrem(k, v)
+        refresh_materialized(pipe, keys, v)
 
         if commit:
-            pipe.execute()
+            cls.execute(pipe)
         else:
             return pipe
 
@@ -361,11 +582,14 @@ class AuthorListingHandler(TimeBasedListingHandler):
         if pipe is None:
             pipe = client.pipeline()
 
-        for k in cls.get_keys(publishable):
-            pipe.zadd(k, cls.get_value(publishable), repr(to_timestamp(publishable.publish_from)))
+        keys = cls.get_keys(publishable)
+        v = cls.get_value(publishable)
+        for k in keys:
+            pipe.zadd(k, v, repr(to_timestamp(publishable.publish_from)))
+        refresh_materialized(pipe, keys, v)
 
         if commit:
-            pipe.execute()
+            cls.execute(pipe)
         else:
             return pipe
 
@@ -393,6 +617,11 @@ class SlidingListingHandler(RedisListingHandler):
     def window_key_zset(cls):
         return ':'.join((cls.PREFIX, 'WINDOWS'))
 
+    # PREFIX -> (day, set of (category_id, content_type_id)) registered by
+    # this process, see register_keys; also used from HitCounter's timer
+    _registered = {}
+    _registered_lock = Lock()
+
     @classmethod
     def get_keys(cls, category, publishable):
         base_keys = super(SlidingListingHandler, cls).get_keys(category, publishable)
@@ -400,13 +629,58 @@ class SlidingListingHandler(RedisListingHandler):
         day_mask = '%%s:%s' % day
         day_keys = [day_mask % k for k in base_keys]
 
-        # store all the keys somewhere so that we can construct windows
-        pipe = client.pipeline()
+        return base_keys + day_keys
+
+    @classmethod
+    def register_keys(cls, category, publishable, pipe):
+        """
+        Store all the keys used for publishable in category somewhere so
+        that we can construct windows. Only done once a day for every
+        category and content type by each process, the keys count as
+        registered once ``pipe`` has been run via ``execute``.
+        """
+        day = date.today().strftime('%Y%m%d')
+        lookup = (category.pk, publishable.content_type_id)
+        with cls._registered_lock:
+            registered_day, registered = cls._registered.get(cls.PREFIX, (None, ()))
+            if registered_day == day and lookup in registered:
+                return
+
+        base_keys = super(SlidingListingHandler, cls).get_keys(category, publishable)
         pipe.sadd(cls.base_key_set(), *base_keys)
-        pipe.zadd(cls.window_key_zset(), **dict((k, day) for k in day_keys))
-        pipe.execute()
+        pipe.zadd(cls.window_key_zset(), **dict(('%s:%s' % (k, day), day) for k in base_keys))
+        if not hasattr(pipe, 'registered_keys'):
+            pipe.registered_keys = []
+        pipe.registered_keys.append((cls.PREFIX, day, lookup))
 
-        return base_keys + day_keys
+    @classmethod
+    def execute(cls, pipe):
+        pending = getattr(pipe, 'registered_keys', [])
+        pipe.registered_keys = []
+        result = super(SlidingListingHandler, cls).execute(pipe)
+
+        with cls._registered_lock:
+            for prefix, day, lookup in pending:
+                registered_day, registered = cls._registered.get(prefix, (None, None))
+                if registered_day != day:
+                    registered = set()
+                    cls._registered[prefix] = (day, registered)
+                registered.add(lookup)
+        return result
+
+    @classmethod
+    def add_publishable(cls, category, publishable, score=None, publish_from=None, pipe=None, commit=True):
+        if pipe is None:
+            pipe = client.pipeline()
+        cls.register_keys(category, publishable, pipe)
+        return super(SlidingListingHandler, cls).add_publishable(category, publishable, score, publish_from, pipe, commit)
+
+    @classmethod
+    def incr_score(cls, category, publishable, incr_by=1, pipe=None, commit=True):
+        if pipe is None:
+            pipe = client.pipeline()
+        cls.register_keys(category, publishable, pipe)
+        return super(SlidingListingHandler, cls).incr_score(category, publishable, incr_by, pipe, commit)
 
     @classmethod
     def remove_publishable(cls, category, publishable, pipe=None, commit=True):
@@ -416,12 +690,15 @@ class SlidingListingHandler(RedisListingHandler):
         days, last_day = cls._get_days()
         base_keys = super(SlidingListingHandler, cls).get_keys(category, publishable)
 
+        time_keys = cls.get_time_keys(category, publishable)
+
         v = cls.get_value(publishable)
-        for k in chain(base_keys, ('%s:%s' % (k, day) for k in base_keys for day in days)):
+        for k in chain(base_keys, ('%s:%s' % (k, day) for k in base_keys for day in days), time_keys):
             pipe.zrem(k, v)
+        refresh_materialized(pipe, base_keys + time_keys, v)
 
         if commit:
-            pipe.execute()
+            cls.execute(pipe)
         else:
             return pipe
 
@@ -440,6 +717,9 @@ class SlidingListingHandler(RedisListingHandler):
     @classmethod
     def regenerate(cls, today=None):
         days, last_day = cls._get_days(today)
+        # make sure keys get registered again should anything be removed
+        with cls._registered_lock:
+            cls._registered.pop(cls.PREFIX, None)
 
         pipe = client.pipeline()
 
@@ -452,20 +732,295 @@ class SlidingListingHandler(RedisListingHandler):
                 # and remove them from the zset index
                 pipe.zremrangebyscore(cls.window_key_zset(), 0, '(' + last_day)
 
-        for k in client.smembers(cls.base_key_set()):
+        keys = client.smembers(cls.base_key_set())
+        for k in keys:
             # store the aggregate for all keys over WINDOW_SIZE days
             pipe.zunionstore(k, ['%s:%s' % (k, day) for day in days], aggregate='SUM')
+        # the keys have been rebuilt, drop anything derived from them
+        refresh_materialized(pipe, keys)
+
+        execute_pipeline(pipe)
+
+
+def _get_live_listings(now=None):
+    " Listings that should be present in redis, ordered by pk. "
+    Listing = get_model('core', 'listing')
+    if now is None:
+        now = timezone.now()
+    return Listing.objects.filter(publishable__published=True).exclude(publishable__publish_to__lt=now).order_by('pk')
+
+
+def _get_keys_data(listings):
+    """
+    Return a dict mapping keys of the redis listing handler and
+    ``AuthorListingHandler`` to ``{value: score}`` of the members
+    ``listings`` contribute to them.
+    """
+    Publishable = get_model('core', 'publishable')
+    handler = ListingHandlerClass()
 
+    data = {}
+    for l in listings:
+        v = handler.get_value(l.publishable)
+        score = repr(to_timestamp(l.publish_from))
+        lkeys = handler.get_time_keys(l.category, l.publishable)
+        if handler.TIME_SCORED:
+            lkeys = lkeys + handler.get_keys(l.category, l.publishable)
+        for k in lkeys:
+            data.setdefault(k, {})[v] = score
+
+    publishables = dict((l.publishable_id, l.publishable) for l in listings)
+    authors = Publishable.authors.through.objects.order_by()
+    for publishable_id, author_id in authors.filter(publishable__in=publishables.keys()).values_list('publishable_id', 'author_id'):
+        p = publishables[publishable_id]
+        k = ':'.join((AuthorListingHandler.PREFIX, 'a', str(author_id)))
+        data.setdefault(k, {})[AuthorListingHandler.get_value(p)] = repr(to_timestamp(p.publish_from))
+    return data
+
+
+def _get_listing_data(chunk_size=1000, now=None):
+    """
+    Stream published listings from the database in chunks of ``chunk_size``
+    ordered by pk and yield, for each chunk, the result of ``_get_keys_data``.
+    """
+    qset = _get_live_listings(now)
+
+    last_pk = 0
+    while True:
+        listings = list(qset.filter(pk__gt=last_pk)[:chunk_size])
+        if not listings:
+            break
+        last_pk = listings[-1].pk
+        yield _get_keys_data(listings)
+
+
+def _scan_keys(match, count=1000):
+    """
+    Iterate over keys matching ``match`` using SCAN so that the server is
+    not blocked the way KEYS would block it.
+    """
+    cursor = None
+    while cursor != 0:
+        cursor, keys = client.scan(cursor or 0, match=match, count=count)
+        cursor = int(cursor)
+        for k in keys:
+            yield k
+
+
+def _get_live_listing_keys():
+    " All keys in redis that _get_listing_data can produce. "
+    handler = ListingHandlerClass()
+    patterns = [(handler.time_prefix(), '((c|d|ct):)?')]
+    if handler.TIME_SCORED:
+        patterns.append((handler.PREFIX, '((c|d|ct):)?'))
+    patterns.append((AuthorListingHandler.PREFIX, 'a:'))
+
+    keys = set()
+    for prefix, middle in patterns:
+        key_re = re.compile(r'^%s:%s\d+$' % (re.escape(prefix), middle))
+        keys.update(k for k in _scan_keys(prefix + ':*') if key_re.match(k))
+    return keys
+
+
+def rebuild_listings(chunk_size=1000, now=None):
+    """
+    Rebuild all the keys maintained by the redis listing handler and
+    ``AuthorListingHandler`` from the database. Listings are written into
+    shadow keys which replace the live ones in a single transaction at the
+    end, live keys no longer backed by any listing are removed.
+
+    Changes the signal handlers write to the live keys while the rebuild
+    runs are overwritten by the shadow keys, run ``check_listings`` with
+    ``repair`` afterwards to pick them up.
+
+    Return the number of keys written.
+    """
+    keys = set()
+    for data in _get_listing_data(chunk_size, now):
+        pipe = client.pipeline(transaction=False)
+        for k, values in data.iteritems():
+            shadow = k + ':rebuild'
+            # leftover from an unfinished rebuild
+            if k not in keys:
+                pipe.delete(shadow)
+                keys.add(k)
+            pipe.zadd(shadow, **values)
         pipe.execute()
 
+    stale = _get_live_listing_keys() - keys
+
+    pipe = client.pipeline()
+    for k in keys:
+        pipe.rename(k + ':rebuild', k)
+    if stale:
+        pipe.delete(*stale)
+    refresh_materialized(pipe, list(keys | stale))
+    execute_pipeline(pipe)
+
+    return len(keys)
+
+
+def check_listings(chunk_size=1000, repair=False, now=None):
+    """
+    Compare the keys maintained by the redis listing handler and
+    ``AuthorListingHandler`` with the database and return a list of
+    ``(key, missing, extra, misscored)`` tuples with the values differing for
+    every inconsistent key. If ``repair`` is set, fix the differences.
+
+    Both sides are compared ``chunk_size`` listings or key members at a
+    time, only the differences are kept in memory.
+    """
+    # (key, value) -> (expected score or None if extra, actual score or None)
+    differences = {}
+
+    # values expected by the database
+    for data in _get_listing_data(chunk_size, now):
+        items = [(k, v, score) for k, values in data.iteritems() for v, score in values.iteritems()]
+        pipe = client.pipeline(transaction=False)
+        for k, v, score in items:
+            pipe.zscore(k, v)
+
+        for (k, v, score), actual in zip(items, pipe.execute()):
+            # later listings win like in rebuild_listings
+            differences.pop((k, v), None)
+            if actual is None or abs(float(score) - actual) > 1e-3:
+                differences[(k, v)] = (score, actual)
+
+    # values present in redis
+    def check_members(members):
+        pks = set(int(v.split(':')[1]) for k, v in members)
+        expected = set()
+        for k, values in _get_keys_data(list(_get_live_listings(now).filter(publishable__in=pks))).iteritems():
+            expected.update((k, v) for v in values)
+        for k, v in members:
+            if (k, v) not in expected:
+                differences[(k, v)] = (None, True)
+
+    members = []
+    for k in sorted(_get_live_listing_keys()):
+        start = 0
+        while True:
+            values = client.zrange(k, start, start + chunk_size - 1)
+            members.extend((k, v) for v in values)
+            if len(members) >= chunk_size:
+                check_members(members)
+                members = []
+            if len(values) < chunk_size:
+                break
+            start += chunk_size
+    if members:
+        check_members(members)
+
+    report = {}
+    for (k, v), (expected, actual) in differences.iteritems():
+        missing, extra, misscored = report.setdefault(k, ([], [], []))
+        if expected is None:
+            extra.append(v)
+        elif actual is None:
+            missing.append(v)
+        else:
+            misscored.append(v)
+    report = [(k, sorted(missing), sorted(extra), sorted(misscored)) for k, (missing, extra, misscored) in sorted(report.iteritems())]
+
+    if repair and report:
+        pipe = client.pipeline()
+        for (k, v), (expected, actual) in differences.iteritems():
+            if expected is None:
+                pipe.zrem(k, v)
+            else:
+                pipe.zadd(k, v, expected)
+        refresh_materialized(pipe, [r[0] for r in report])
+        execute_pipeline(pipe)
+
+    return report
+
+
+class HitCounter(object):
+    """
+    Collects hits of rendered publishables in memory and feeds them to
+    ``handler.incr_score`` in a single pipeline once ``interval`` seconds
+    passed since the first buffered hit or ``size`` different publishables
+    have been hit, whichever comes first. Flushes run one at a time, either
+    in the thread that filled the buffer or in a timer thread, and cost a
+    single round trip to redis.
+    """
+    def __init__(self, handler, interval, size):
+        self.handler = handler
+        self.interval = interval
+        self.size = size
+        self._hits = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._timer = None
+
+    def hit(self, category, publishable, count=1):
+        key = (category, publishable)
+        if key not in self._hits:
+            # look the keys up while in the request thread, a flush from the
+            # timer then finds the propagated ancestors in the local cache
+            # unless they expired meanwhile, only the closure version may
+            # have to be read from the shared cache again
+            self.handler.get_keys(category, publishable)
+
+        with self._lock:
+            self._hits[key] = self._hits.get(key, 0) + count
+            full = len(self._hits) >= self.size
+            if not full and self._timer is None:
+                self._timer = Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            hits, self._hits = self._hits, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if not hits:
+            return
+
+        with self._flush_lock:
+            try:
+                pipe = client.pipeline()
+                for (category, publishable), count in hits.iteritems():
+                    self.handler.incr_score(category, publishable, incr_by=count, pipe=pipe, commit=False)
+                self.handler.execute(pipe)
+            except Exception:
+                log.exception('Failed to store %d hits in redis.', sum(hits.values()))
+
+
+hit_counter = None
+
+
+def get_hit_counter_handler():
+    """
+    Return the listing handler named by ``HIT_COUNTER_HANDLER``, it has to
+    be one of the redis listing handlers from ``LISTING_HANDLERS`` scored by
+    something else than time.
+    """
+    handler = get_model('core', 'Listing').objects.get_listing_handler(core_settings.HIT_COUNTER_HANDLER, fallback=False)
+    if handler is None or not issubclass(handler, RedisListingHandler) or handler.TIME_SCORED:
+        raise ImproperlyConfigured('HIT_COUNTER_HANDLER %r is not a redis listing handler scored by hits from LISTING_HANDLERS.' % core_settings.HIT_COUNTER_HANDLER)
+    return handler
+
+
+def publishable_rendered(sender, category, publishable, **kwargs):
+    if publishable is not None:
+        hit_counter.hit(category, publishable)
+
 
 def connect_signals():
     from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed
-    from ella.core.signals import content_published, content_unpublished
+    from ella.core.signals import content_published, content_unpublished, object_rendered
     from ella.core.models import Listing, Publishable
 
     if not core_settings.USE_REDIS_FOR_LISTINGS:
         return
+
     # when redis is availible, use it for authors
     m2m_changed.connect(update_authors, sender=Publishable._meta.get_field('authors').rel.through)
 
@@ -478,3 +1033,14 @@ def connect_signals():
     pre_delete.connect(listing_pre_delete, sender=Listing)
     post_delete.connect(listing_post_delete, sender=Listing)
 
+    if core_settings.HIT_COUNTER_HANDLER:
+        global hit_counter
+        hit_counter = HitCounter(
+            get_hit_counter_handler(),
+            core_settings.HIT_COUNTER_INTERVAL,
+            core_settings.HIT_COUNTER_SIZE
+        )
+        # don't lose the buffered hits on regular shutdown
+        atexit.register(hit_counter.flush)
+        object_rendered.connect(publishable_rendered)
+
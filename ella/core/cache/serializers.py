@@ -0,0 +1,76 @@
+"""
+Serializers used to store model instances retrieved by ``get_cached_object``
+and ``get_cached_objects`` in the cache. Which one is used is determined by
+``CACHE_OBJECT_SERIALIZER`` setting. Both share the cache keys, ``loads``
+returns ``None`` for data the serializer didn't write so that switching
+the setting only causes cache misses.
+"""
+from zlib import crc32
+
+from django.db import router
+from django.db.models import Model
+from django.db.models.fields.files import FieldFile
+from django.contrib.contenttypes.models import ContentType
+
+from app_data.containers import AppDataContainerFactory
+
+
+class PickleSerializer(object):
+    """
+    Store the instances as they are, the cache backend will pickle them
+    including their ``_state`` and any cached related objects.
+    """
+    def dumps(self, obj):
+        return obj
+
+    def loads(self, data):
+        if not isinstance(data, Model):
+            return None
+        return data
+
+
+class RowSerializer(object):
+    """
+    Store only the values of the model's concrete fields as a tuple along
+    with the id of its ``ContentType`` and a schema version. Values written
+    with an outdated schema are treated as missing.
+    """
+    def __init__(self):
+        self._schemas = {}
+
+    def get_schema(self, model):
+        try:
+            return self._schemas[model]
+        except KeyError:
+            fields = tuple(f.attname for f in model._meta.fields)
+            schema = self._schemas[model] = (fields, crc32(','.join(fields)))
+            return schema
+
+    def _get_value(self, obj, attname):
+        value = obj.__dict__.get(attname)
+        if isinstance(value, FieldFile):
+            return value.name
+        if isinstance(value, AppDataContainerFactory):
+            return value.serialize()
+        return value
+
+    def dumps(self, obj):
+        fields, version = self.get_schema(obj.__class__)
+        return (
+            ContentType.objects.get_for_model(obj).pk,
+            version,
+            tuple(self._get_value(obj, f) for f in fields)
+        )
+
+    def loads(self, data):
+        if not (isinstance(data, tuple) and len(data) == 3):
+            return None
+        ct_id, version, values = data
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is None or version != self.get_schema(model)[1]:
+            return None
+
+        obj = model(*values)
+        obj._state.adding = False
+        obj._state.db = router.db_for_read(model)
+        return obj
@@ -1,7 +1,12 @@
+from copy import copy
 from hashlib import md5
 import logging
+import threading
+import time
+from functools import wraps
 
 from django.dispatch import receiver
+from django.db import transaction
 from django.db.models import ObjectDoesNotExist
 from django.db.models.loading import get_model
 from django.db.models.signals import post_save, post_delete
@@ -12,14 +17,51 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import smart_str
 from django.conf import settings
 
+from ella.core.cache.local import LocalCache
+from ella.core.conf import core_settings
+from ella.utils import import_module_member
+
 
 log = logging.getLogger('ella.core.cache.utils')
 
 KEY_PREFIX = 'ella.obj'
 CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 10 * 60)
 
+# how the objects are stored in cache, see ella.core.cache.serializers
+serializer = import_module_member(core_settings.CACHE_OBJECT_SERIALIZER, 'cache serializer')()
+
+# process-local tier in front of the cache for models in CACHE_LOCAL_MODELS
+local_cache = LocalCache(core_settings.CACHE_LOCAL_SIZE, core_settings.CACHE_LOCAL_TIMEOUT)
+
+
+# objects retrieved during current request, see IdentityMapMiddleware
+_identity_map = threading.local()
+
+
+def enable_identity_map():
+    _identity_map.objects = {}
+
+
+def disable_identity_map():
+    _identity_map.objects = None
+
+
+def _get_identity_map():
+    return getattr(_identity_map, 'objects', None)
+
+
+def _get_identity_key(model, pk):
+    return (_get_key_model(model).pk, str(pk))
+
+
+# invalidations queued by invalidation_batch
+_invalidations = threading.local()
+
 
 def invalidate_cache(sender, instance, **kwargs):
+    opts = instance._meta
+    if '%s.%s' % (opts.app_label, opts.module_name) in core_settings.CACHE_INVALIDATION_EXCLUDE:
+        return
     invalidate_cache_for_object(instance)
 
 
@@ -29,11 +71,101 @@ def connect_invalidation_signals():
 
 
 def invalidate_cache_for_object(obj):
-    key = _get_key(KEY_PREFIX, ContentType.objects.get_for_model(obj), pk=obj.pk, version_key=True)
+    ct = ContentType.objects.get_for_model(obj)
+    identity_map = _get_identity_map()
+    if identity_map:
+        identity_map.pop(_get_identity_key(ct, obj.pk), None)
+
+    keys = (
+        _get_key(KEY_PREFIX, ct, pk=obj.pk, version_key=True),
+        # any change can make a previously missing object appear
+        _get_model_version_key(KEY_PREFIX, ct),
+    )
+    queue = getattr(_invalidations, 'keys', None)
+    if queue is not None:
+        queue.update(keys)
+    else:
+        for key in keys:
+            _bump_version(key)
+
+
+def _bump_version(key):
     try:
         cache.incr(key)
     except ValueError:
-        cache.set(key, 1, timeout=CACHE_TIMEOUT)
+        # somebody else may be creating the key at the same time
+        if not cache.add(key, 1, timeout=CACHE_TIMEOUT):
+            cache.incr(key)
+
+
+def _bump_versions(keys):
+    # atomic increments only, a get_many/set_many pair would lose
+    # concurrent changes
+    for key in keys:
+        _bump_version(key)
+
+
+class invalidation_batch(object):
+    """
+    Run the wrapped block in a transaction (``commit_on_success``) and
+    postpone cache invalidation of all the objects saved or deleted within
+    it until the transaction is committed. Every object is invalidated only
+    once. Nothing is invalidated if the block raises an exception and the
+    transaction is rolled back.
+
+    Can be used as a context manager or as a decorator, nested batches are
+    flushed together with the outermost one::
+
+        with invalidation_batch():
+            for obj in objects:
+                obj.save()
+    """
+    def __init__(self, using=None):
+        self.using = using
+
+    def __enter__(self):
+        self.outermost = getattr(_invalidations, 'keys', None) is None
+        if self.outermost:
+            _invalidations.keys = set()
+        self.transaction = transaction.commit_on_success(using=self.using)
+        self.transaction.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.transaction.__exit__(exc_type, exc_value, traceback)
+        finally:
+            if self.outermost:
+                keys = _invalidations.keys
+                _invalidations.keys = None
+                if exc_type is None and keys:
+                    _bump_versions(list(keys))
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapped_func(*args, **kwargs):
+            with self.__class__(self.using):
+                return func(*args, **kwargs)
+        return wrapped_func
+
+
+class Tombstone(object):
+    """
+    Cached in place of an object that doesn't exist. Only valid as long as
+    the model's version stamp hasn't changed.
+    """
+    def __init__(self, version):
+        self.version = version
+
+
+class CachedResult(object):
+    """
+    Result of a function decorated by ``cache_this`` along with the time it
+    expires. Anything else found under the key (e.g. values stored by older
+    versions) is ignored.
+    """
+    def __init__(self, expires, result):
+        self.expires = expires
+        self.result = result
 
 
 def normalize_key(key):
@@ -42,15 +174,18 @@ def normalize_key(key):
     return md5(key).hexdigest()
 
 
-def _get_key(start, model, pk=None, version_key=False, **kwargs):
+def _get_key_model(model):
     Publishable = get_model('core', 'publishable')
     if issubclass(model.model_class(), Publishable) and model.model_class() != Publishable:
         model = ContentType.objects.get_for_model(Publishable)
+    return model
+
+
+def _get_key(start, model, pk=None, version_key=False, **kwargs):
+    model = _get_key_model(model)
 
     if pk and not kwargs:
-        key = ':'.join((
-            start, str(model.pk), str(pk)
-        ))
+        key = _get_pk_key(start, model, pk)
         if version_key:
             return key + ':VER'
         version = cache.get(key + ':VER') or '0'
@@ -67,6 +202,71 @@ def _get_key(start, model, pk=None, version_key=False, **kwargs):
     )))
 
 
+def _get_pk_key(start, model, pk):
+    " Key for object with given pk without the version. "
+    return ':'.join((start, str(_get_key_model(model).pk), str(pk)))
+
+
+def _get_model_version_key(start, model):
+    return ':'.join((start, str(_get_key_model(model).pk), 'VER'))
+
+
+def _use_local_cache(model):
+    if not core_settings.CACHE_LOCAL_MODELS:
+        return False
+    key_model = _get_key_model(model)
+    return '%s.%s' % (model.app_label, model.model) in core_settings.CACHE_LOCAL_MODELS or \
+        '%s.%s' % (key_model.app_label, key_model.model) in core_settings.CACHE_LOCAL_MODELS
+
+
+def _get_keys(start, pks):
+    """
+    Bulk version of ``_get_key`` for a list of ``(ContentType, pk)`` pairs.
+    All the version stamps are retrieved using a single ``get_many`` call.
+    """
+    keys = [_get_pk_key(start, model, pk) for (model, pk) in pks]
+    versions = cache.get_many([key + ':VER' for key in keys])
+    return ['%s:%s' % (key, versions.get(key + ':VER') or '0') for key in keys]
+
+
+def _get_publishable_type_key(pk):
+    return ':'.join((KEY_PREFIX, 'TYPE', str(pk)))
+
+
+def _get_publishable_types(pks):
+    """
+    Return a dict mapping given Publishable pks to the ``ContentType`` of
+    their concrete subclass. Content type of a publishable never changes so
+    the mapping is remembered in the cache (and in the process-local cache
+    if publishables are listed in ``CACHE_LOCAL_MODELS``) and the database
+    is only queried for the pks never seen before.
+    """
+    local = _use_local_cache(ContentType.objects.get_for_model(get_model('core', 'publishable')))
+    keys = dict((_get_publishable_type_key(pk), int(pk)) for pk in pks)
+    types = local_cache.get_many(keys.keys()) if local else {}
+    if len(types) < len(keys):
+        types.update(cache.get_many([k for k in keys if k not in types]))
+    types = dict((keys[k], ct_id) for (k, ct_id) in types.iteritems())
+
+    missing = [pk for pk in keys.itervalues() if pk not in types]
+    if missing:
+        qset = get_model('core', 'publishable')._default_manager.filter(pk__in=missing)
+        # missing pks that don't exist are simply left out
+        found = dict(qset.values_list('id', 'content_type_id'))
+        _remember_publishable_types(found.items(), local)
+        types.update(found)
+
+    return dict((pk, ContentType.objects.get_for_id(ct_id)) for (pk, ct_id) in types.iteritems())
+
+
+def _remember_publishable_types(types, local):
+    data = dict((_get_publishable_type_key(pk), ct_id) for (pk, ct_id) in types)
+    if data:
+        if local:
+            local_cache.set_many(data)
+        cache.set_many(data, timeout=CACHE_TIMEOUT)
+
+
 def get_cached_object(model, timeout=CACHE_TIMEOUT, **kwargs):
     """
     Return a cached object. If the object does not exist in the cache, create it.
@@ -84,29 +284,124 @@ def get_cached_object(model, timeout=CACHE_TIMEOUT, **kwargs):
     else:
         model_ct = model
 
+    identity_map = _get_identity_map()
+    if identity_map is not None and kwargs.keys() == ['pk']:
+        try:
+            return identity_map[_get_identity_key(model_ct, kwargs['pk'])]
+        except KeyError:
+            pass
+
+    obj = _get_cached_object(model_ct, timeout, **kwargs)
+    if identity_map is not None:
+        obj = identity_map.setdefault(_get_identity_key(model_ct, obj.pk), obj)
+    return obj
+
+
+def _get_cached_object(model_ct, timeout, **kwargs):
+    if kwargs.keys() != ['pk']:
+        return _get_cached_object_by_lookup(model_ct, timeout, **kwargs)
+
     key = _get_key(KEY_PREFIX, model_ct, **kwargs)
 
+    # only versioned pk lookups can be served from the process-local cache
+    local = _use_local_cache(model_ct)
+
+    if local:
+        obj = local_cache.get(key)
+        if obj is not None:
+            # don't share the instance between threads and requests
+            return copy(obj)
+
     obj = cache.get(key)
+    version_key = _get_model_version_key(KEY_PREFIX, model_ct)
+    if isinstance(obj, Tombstone):
+        _check_tombstone(obj, model_ct, version_key)
+        obj = None
+    elif obj is not None:
+        obj = serializer.loads(obj)
+
     if obj is None:
-        # if we are looking for a publishable, fetch just the actual content
-        # type and then fetch the actual object
-        if model_ct.app_label == 'core' and model_ct.model == 'publishable':
-            actual_ct_id = model_ct.model_class()._default_manager.values('content_type_id').get(**kwargs)['content_type_id']
-            model_ct = ContentType.objects.get_for_id(actual_ct_id)
+        # read the version before the lookup, concurrent save will invalidate
+        # the tombstone
+        version = cache.get(version_key) or 0
+        try:
+            obj = _fetch_object(model_ct, **kwargs)
+        except ObjectDoesNotExist:
+            cache.set(key, Tombstone(version), core_settings.CACHE_MISS_TIMEOUT)
+            raise
+        cache.set(key, serializer.dumps(obj), timeout)
+
+    if local:
+        local_cache.set(key, copy(obj))
 
-        # fetch the actual object we want
-        obj = model_ct.model_class()._default_manager.get(**kwargs)
+    return obj
 
-        # since 99% of lookups are done via PK make sure we set the cache for
-        # that lookup even if we retrieved it using a different one.
-        if 'pk' in kwargs:
-            cache.set(key, obj, timeout)
-        elif not isinstance(cache, DummyCache):
-            cache.set_many({key: obj, _get_key(KEY_PREFIX, model_ct, pk=obj.pk): obj}, timeout=timeout)
 
+def _get_cached_object_by_lookup(model_ct, timeout, **kwargs):
+    """
+    Lookups other than by pk only store ``(pk, version)`` of the object
+    found, the object itself is always stored under its versioned pk key.
+    Once the object changes, the lookup is verified against the database
+    again. Anything else found under the lookup key, like whole objects
+    cached by older versions, is a miss.
+    """
+    key = _get_key(KEY_PREFIX, model_ct, **kwargs)
+
+    ref = cache.get(key)
+    version_key = _get_model_version_key(KEY_PREFIX, model_ct)
+    if isinstance(ref, Tombstone):
+        _check_tombstone(ref, model_ct, version_key)
+    elif isinstance(ref, tuple) and len(ref) == 2:
+        pk, version = ref
+        pk_key = _get_pk_key(KEY_PREFIX, model_ct, pk)
+        obj_key = '%s:%s' % (pk_key, version)
+        cached = cache.get_many([pk_key + ':VER', obj_key])
+        if (cached.get(pk_key + ':VER') or 0) == version and obj_key in cached:
+            obj = serializer.loads(cached[obj_key])
+            if obj is not None:
+                return obj
+
+    version = cache.get(version_key) or 0
+    try:
+        obj = _fetch_object(model_ct, **kwargs)
+    except ObjectDoesNotExist:
+        cache.set(key, Tombstone(version), core_settings.CACHE_MISS_TIMEOUT)
+        raise
+
+    pk_key = _get_pk_key(KEY_PREFIX, model_ct, obj.pk)
+    version = cache.get(pk_key + ':VER') or 0
+    cache.set_many({
+        key: (obj.pk, version),
+        '%s:%s' % (pk_key, version): serializer.dumps(obj)
+    }, timeout=timeout)
     return obj
 
 
+def _check_tombstone(tombstone, model_ct, version_key):
+    " Raise DoesNotExist if the tombstone is still valid. "
+    if tombstone.version == (cache.get(version_key) or 0):
+        model = model_ct.model_class()
+        raise model.DoesNotExist('%s matching query does not exist.' % model._meta.object_name)
+
+
+def _fetch_object(model_ct, **kwargs):
+    # if we are looking for a publishable, find out the actual content
+    # type and then fetch the actual object
+    if model_ct.app_label == 'core' and model_ct.model == 'publishable':
+        if kwargs.keys() == ['pk'] and kwargs['pk'] is not None:
+            try:
+                model_ct = _get_publishable_types([kwargs['pk']])[int(kwargs['pk'])]
+            except KeyError:
+                raise model_ct.model_class().DoesNotExist(
+                    'Publishable matching query does not exist.')
+        else:
+            actual_ct_id = model_ct.model_class()._default_manager.values('content_type_id').get(**kwargs)['content_type_id']
+            model_ct = ContentType.objects.get_for_id(actual_ct_id)
+
+    # fetch the actual object we want
+    return model_ct.model_class()._default_manager.get(**kwargs)
+
+
 RAISE, SKIP, NONE = 0, 1, 2
 
 
@@ -129,9 +424,50 @@ def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
     else:
         pks = [(ContentType.objects.get_for_id(ct_id), pk) for (ct_id, pk) in pks]
 
-    keys = [_get_key(KEY_PREFIX, model, pk=pk) for (model, pk) in pks]
+    identity_map = _get_identity_map()
+    if identity_map is None:
+        objects = _get_cached_objects(pks, timeout)
+    else:
+        idents = [_get_identity_key(model, pk) for (model, pk) in pks]
+        to_get = dict((i, p) for (i, p) in zip(idents, pks) if i not in identity_map).items()
+        if to_get:
+            for (i, p), obj in zip(to_get, _get_cached_objects([p for (i, p) in to_get], timeout)):
+                if obj is not None:
+                    identity_map[i] = obj
+        objects = [identity_map.get(i) for i in idents]
+
+    out = []
+    for (model, pk), obj in zip(pks, objects):
+        if obj is not None:
+            out.append(obj)
+        elif missing == NONE:
+            out.append(None)
+        elif missing == RAISE:
+            model = _get_key_model(model).model_class()
+            raise model.DoesNotExist(
+                '%s matching query does not exist.' % model._meta.object_name)
+    return out
 
-    cached = cache.get_many(keys)
+
+def _get_cached_objects(pks, timeout):
+    """
+    Return objects for given (ContentType, pk) pairs, None for missing ones.
+    """
+    keys = _get_keys(KEY_PREFIX, pks)
+
+    # keys that can be served from the process-local cache
+    local_keys = set(k for (k, (model, pk)) in zip(keys, pks) if _use_local_cache(model))
+
+    cached = dict((k, copy(v)) for k, v in local_cache.get_many(local_keys).iteritems()) if local_keys else {}
+    local_keys.difference_update(cached.keys())
+    if len(cached) < len(keys):
+        for k, v in cache.get_many([k for k in keys if k not in cached]).iteritems():
+            # validating tombstones would cost another round trip, just refetch
+            if isinstance(v, Tombstone):
+                continue
+            obj = serializer.loads(v)
+            if obj is not None:
+                cached[k] = obj
 
     # keys not in cache
     keys_to_set = set(keys) - set(cached.keys())
@@ -149,10 +485,7 @@ def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
         publishable_ct = ContentType.objects.get_for_model(get_model('core', 'publishable'))
         if publishable_ct in to_get:
             publishable_keys = to_get.pop(publishable_ct)
-            models = publishable_ct.model_class()._default_manager.values('content_type_id', 'id').filter(id__in=publishable_keys.keys())
-            for m in models:
-                ct = ContentType.objects.get_for_id(m['content_type_id'])
-                pk = m['id']
+            for pk, ct in _get_publishable_types(publishable_keys.keys()).iteritems():
                 # and put them back as their native content_type
                 to_get.setdefault(ct, {})[pk] = publishable_keys[pk]
 
@@ -166,22 +499,12 @@ def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
 
         if not isinstance(cache, DummyCache):
             # write them into cache
-            cache.set_many(to_set, timeout=timeout)
+            cache.set_many(dict((k, serializer.dumps(m)) for k, m in to_set.iteritems()), timeout=timeout)
 
-    out = []
-    for k in keys:
-        try:
-            out.append(cached[k])
-        except KeyError:
-            if missing == NONE:
-                out.append(None)
-            elif missing == SKIP:
-                pass
-            elif missing == RAISE:
-                ct = ContentType.objects.get_for_id(int(k.split(':')[1]))
-                raise ct.model_class().DoesNotExist(
-                    '%s matching query does not exist.' % ct.model_class()._meta.object_name)
-    return out
+    if local_keys:
+        local_cache.set_many(dict((k, copy(cached[k])) for k in local_keys if k in cached))
+
+    return [cached.get(k) for k in keys]
 
 
 def get_cached_object_or_404(model, timeout=CACHE_TIMEOUT, **kwargs):
@@ -197,17 +520,32 @@ def get_cached_object_or_404(model, timeout=CACHE_TIMEOUT, **kwargs):
 
 
 def cache_this(key_getter, timeout=CACHE_TIMEOUT):
+    """
+    Cache the result of the decorated function under the key returned by
+    ``key_getter``.
+
+    Results are kept in cache for ``CACHE_STALE_TIMEOUT`` seconds after they
+    expire. When an expired result is found, only the process that manages to
+    acquire a short lock (``CACHE_REFRESH_TIMEOUT``) recomputes it, everybody
+    else keeps serving the stale result in the meantime.
+    """
     def wrapped_decorator(func):
         def wrapped_func(*args, **kwargs):
             key = key_getter(*args, **kwargs)
-            if key is not None:
-                result = cache.get(key)
+            if key is None:
+                return func(*args, **kwargs)
+
+            cached = cache.get(key)
+            if isinstance(cached, CachedResult):
+                # still fresh or somebody else is already refreshing it
+                if cached.expires > time.time() or not cache.add(key + ':LOCK', 1, core_settings.CACHE_REFRESH_TIMEOUT):
+                    return cached.result
+                log.debug('cache_this(key=%s), refreshing stale object.', key)
             else:
-                result = None
-            if result is None:
                 log.debug('cache_this(key=%s), object not cached.', key)
-                result = func(*args, **kwargs)
-                cache.set(key, result, timeout)
+
+            result = func(*args, **kwargs)
+            cache.set(key, CachedResult(time.time() + timeout, result), timeout + core_settings.CACHE_STALE_TIMEOUT)
             return result
 
         wrapped_func.__dict__ = func.__dict__
@@ -216,4 +554,3 @@ def cache_this(key_getter, timeout=CACHE_TIMEOUT):
 
         return wrapped_func
     return wrapped_decorator
-
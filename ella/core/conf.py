@@ -8,6 +8,27 @@ gettext = lambda s: s
 CACHE_TIMEOUT = 10 * 60
 CACHE_TIMEOUT_LONG = 60 * 60
 
+# how get_cached_object(s) store model instances in cache
+CACHE_OBJECT_SERIALIZER = 'ella.core.cache.serializers.PickleSerializer'
+
+# models ('app_label.model') whose changes never invalidate the object cache
+CACHE_INVALIDATION_EXCLUDE = ('sessions.session', 'admin.logentry', 'south.migrationhistory')
+
+# lookups for objects that don't exist are cached for CACHE_MISS_TIMEOUT
+CACHE_MISS_TIMEOUT = 30
+
+# cache_this serves stale results for CACHE_STALE_TIMEOUT seconds after they
+# expire while a single process (holding a lock for at most
+# CACHE_REFRESH_TIMEOUT seconds) recomputes them
+CACHE_STALE_TIMEOUT = 60
+CACHE_REFRESH_TIMEOUT = 10
+
+# process-local LRU in front of the cache for objects of these models
+# ('app_label.model'), keyed by the versioned cache key
+CACHE_LOCAL_MODELS = ()
+CACHE_LOCAL_SIZE = 1000
+CACHE_LOCAL_TIMEOUT = 60
+
 DOUBLE_RENDER = False
 DOUBLE_RENDER_EXCLUDE_URLS = None
 
@@ -39,6 +60,22 @@ LISTING_HANDLERS = {
 USE_REDIS_FOR_LISTINGS = False
 REDIS_LISTING_HANDLER = 'default'
 
+# name of the listing handler (from LISTING_HANDLERS) whose incr_score is fed
+# with hits of rendered publishables, hits are buffered in memory and flushed
+# every HIT_COUNTER_INTERVAL seconds or when HIT_COUNTER_SIZE publishables
+# have been hit
+HIT_COUNTER_HANDLER = None
+HIT_COUNTER_INTERVAL = 10
+HIT_COUNTER_SIZE = 1000
+
+# keep counts of listings used for pagination in the cache for up to
+# LISTING_COUNT_TIMEOUT seconds, adjusted as listings change; None (default)
+# counts the listings on every request
+LISTING_COUNT_TIMEOUT = None
+
+# maintain the denormalized ListingFeedItem table used by FeedListingHandler
+USE_LISTING_FEED = False
+
 # Category settings
 CATEGORY_TEMPLATES = (
     ('category.html', gettext('default (category.html)')),
@@ -0,0 +1,96 @@
+"""
+Keeps the denormalized ``ListingFeedItem`` table in sync with listings,
+publishables and categories when ``USE_LISTING_FEED`` is set.
+"""
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.loading import get_model
+
+from ella.core.conf import core_settings
+
+
+def refresh_listings(qset, chunk_size=1000, commit=False):
+    """
+    Recreate feed items of the listings in ``qset``, ``chunk_size`` listings
+    at a time, committing every chunk if ``commit`` is set. Returns the
+    number of items created.
+    """
+    ListingFeedItem = get_model('core', 'listingfeeditem')
+
+    count = 0
+    last_pk = 0
+    while True:
+        listings = list(qset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not listings:
+            return count
+        if commit:
+            with transaction.commit_on_success():
+                count += ListingFeedItem.objects.refresh(listings)
+        else:
+            count += ListingFeedItem.objects.refresh(listings)
+        last_pk = listings[-1].pk
+
+
+def rebuild_feed(chunk_size=1000):
+    """
+    Recreate the whole feed table from the listings, ``chunk_size`` listings
+    at a time. Every chunk is replaced in its own transaction so the feed
+    stays complete while it is being rebuilt. Returns the number of items
+    created.
+    """
+    Listing = get_model('core', 'listing')
+    ListingFeedItem = get_model('core', 'listingfeeditem')
+
+    count = refresh_listings(Listing.objects.all(), chunk_size, commit=True)
+    # items left behind by listings removed without signals
+    with transaction.commit_on_success():
+        ListingFeedItem.objects.exclude(listing__in=Listing.objects.values('pk')).delete()
+    return count
+
+
+def listing_post_save(sender, instance, **kwargs):
+    ListingFeedItem = get_model('core', 'listingfeeditem')
+    ListingFeedItem.objects.refresh([instance])
+
+
+def publishable_post_save(sender, instance, **kwargs):
+    Publishable = get_model('core', 'publishable')
+    ListingFeedItem = get_model('core', 'listingfeeditem')
+    if not isinstance(instance, Publishable):
+        return
+
+    listings = list(instance.listing_set.all())
+    for l in listings:
+        # use the fresh instance instead of the one cached on the listing
+        l.publishable = instance
+    ListingFeedItem.objects.refresh(listings)
+
+
+def category_pre_save(sender, instance, **kwargs):
+    instance._old_feed_path = list(sender.objects.filter(pk=instance.pk).values_list('tree_path', flat=True)) if instance.pk else []
+
+
+def category_post_save(sender, instance, **kwargs):
+    Listing = get_model('core', 'listing')
+
+    old_path = getattr(instance, '_old_feed_path', None)
+    instance._old_feed_path = None
+    if old_path == [instance.tree_path]:
+        return
+
+    # paths and urls change, Category.save takes care of the children
+    refresh_listings(Listing.objects.filter(Q(category=instance) | Q(publishable__category=instance)))
+
+
+def connect_signals():
+    from django.db.models.signals import pre_save, post_save
+    from ella.core.models import Listing, Category
+
+    if not core_settings.USE_LISTING_FEED:
+        return
+
+    post_save.connect(listing_post_save, sender=Listing)
+    pre_save.connect(category_pre_save, sender=Category)
+    post_save.connect(category_post_save, sender=Category)
+    # sent with the concrete subclasses as sender
+    post_save.connect(publishable_post_save)
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ella.core.cache.benchmark import BENCHMARKS
+
+
+class Command(BaseCommand):
+    args = '[%s]' % ' '.join(sorted(BENCHMARKS))
+    help = 'Benchmark the object cache using the objects in the database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--number', type='int', dest='number', default=1000,
+            help='How many times to repeat each measurement.'),
+    )
+
+    def handle(self, *args, **options):
+        for name in args or sorted(BENCHMARKS):
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark %r.' % name)
+            func, header = BENCHMARKS[name]
+            self.stdout.write('%s\n' % name)
+            for row in [header] + func(number=options['number']):
+                self.stdout.write('\t'.join(map(str, row)) + '\n')
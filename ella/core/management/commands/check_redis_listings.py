@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ella.core.cache import redis
+from ella.core.conf import core_settings
+
+
+class Command(NoArgsCommand):
+    help = 'Compare listings stored in redis with the database.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='How many listings or keys to process at once.'),
+        make_option('--repair', action='store_true', dest='repair', default=False,
+            help='Fix the differences found.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not core_settings.USE_REDIS_FOR_LISTINGS or redis.client is None:
+            raise CommandError('Redis listings are not enabled.')
+        if not issubclass(redis.ListingHandlerClass(), redis.RedisListingHandler):
+            raise CommandError('REDIS_LISTING_HANDLER is not a redis listing handler.')
+
+        report = redis.check_listings(options['chunk_size'], repair=options['repair'])
+        for key, missing, extra, misscored in report:
+            self.stdout.write('%s\tmissing: %d\textra: %d\tmisscored: %d\n' % (key, len(missing), len(extra), len(misscored)))
+        self.stdout.write('%d inconsistent keys%s.\n' % (len(report), ' repaired' if options['repair'] else ''))
@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ella.core.conf import core_settings
+from ella.core.listing_feed import rebuild_feed
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the denormalized listing feed table from the listings.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='How many listings to process at once.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not core_settings.USE_LISTING_FEED:
+            raise CommandError('Listing feed is not enabled.')
+
+        count = rebuild_feed(options['chunk_size'])
+        self.stdout.write('Rebuilt %d feed items.\n' % count)
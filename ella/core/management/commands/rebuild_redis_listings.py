@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ella.core.cache import redis
+from ella.core.conf import core_settings
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuild listings stored in redis from the database. Changes made while '
+            'it runs are overwritten, run check_redis_listings --repair afterwards.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='How many listings to process at once.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not core_settings.USE_REDIS_FOR_LISTINGS or redis.client is None:
+            raise CommandError('Redis listings are not enabled.')
+        if not issubclass(redis.ListingHandlerClass(), redis.RedisListingHandler):
+            raise CommandError('REDIS_LISTING_HANDLER is not a redis listing handler.')
+
+        count = redis.rebuild_listings(options['chunk_size'])
+        self.stdout.write('Rebuilt %d keys.\n' % count)
@@ -1,12 +1,14 @@
 from operator import attrgetter
 
-from django.db import models
+from django.db import models, connections
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import smart_str
 from django.db.models.loading import get_model
 from django.conf import settings
 
-from ella.core.cache import cache_this
+from ella.core.cache import cache_this, prefetch_cached
+from ella.core.cache.local import LocalCache
+from ella.core.cache.utils import cache, _bump_version
 from ella.core.conf import core_settings
 from ella.utils import timezone, import_module_member
 
@@ -79,6 +81,76 @@ class CategoryManager(models.Manager):
         return children
 
 
+class CategoryClosureManager(models.Manager):
+    # bumped in the shared cache whenever the closure changes
+    VERSION_KEY = 'core.category_closure:VER'
+    # seconds the version is trusted without asking the shared cache
+    VERSION_TIMEOUT = 5
+
+    _version = LocalCache(1, VERSION_TIMEOUT)
+    # (version, category id) -> result of get_propagated
+    _propagated = LocalCache(core_settings.CACHE_LOCAL_SIZE, core_settings.CACHE_LOCAL_TIMEOUT)
+
+    def get_version(self):
+        version = self._version.get(self.VERSION_KEY)
+        if version is None:
+            version = cache.get(self.VERSION_KEY) or 0
+            self._version.set(self.VERSION_KEY, version)
+        return version
+
+    def get_propagated(self, category):
+        """
+        Return ids of the ancestors of ``category`` whose listings including
+        children contain listings in ``category``, the nearest first. Kept
+        in memory until any process rebuilds part of the closure, which other
+        processes notice within ``VERSION_TIMEOUT`` seconds.
+        """
+        key = (self.get_version(), category.pk)
+        ancestors = self._propagated.get(key)
+        if ancestors is None:
+            ancestors = list(self.filter(descendant=category, depth__gt=0, propagates=True)
+                .order_by('depth').values_list('ancestor_id', flat=True))
+            self._propagated.set(key, ancestors)
+        return ancestors
+
+    def rebuild(self, category, recursive=True):
+        """
+        Recompute the rows describing ``category`` (and all its descendants
+        if ``recursive``) from the category tree.
+        """
+        Category = get_model('core', 'category')
+
+        chain = [category]
+        while chain[-1].tree_parent_id:
+            chain.append(chain[-1].tree_parent)
+
+        # descendant_id -> [(ancestor_id, depth, propagates), ...]
+        closure = {category.pk: []}
+        propagates = True
+        for depth, c in enumerate(chain):
+            closure[category.pk].append((c.pk, depth, propagates))
+            propagates = propagates and c.app_data.ella.propagate_listings
+
+        level = [category]
+        while recursive and level:
+            level = list(Category.objects.filter(tree_parent__in=level))
+            for c in level:
+                propagates = c.app_data.ella.propagate_listings
+                closure[c.pk] = [(c.pk, 0, True)] + [
+                        (a, depth + 1, p and propagates) for (a, depth, p) in closure[c.tree_parent_id]
+                    ]
+
+        self.filter(descendant__in=closure.keys()).delete()
+        self.bulk_create([
+                self.model(ancestor_id=a, descendant_id=d, depth=depth, propagates=p)
+                for d, rows in closure.items() for (a, depth, p) in rows
+            ])
+
+        _bump_version(self.VERSION_KEY)
+        self._version.clear()
+        self._propagated.clear()
+
+
 class RelatedManager(models.Manager):
     def collect_related(self, finder_funcs, obj, count, *args, **kwargs):
         """
@@ -143,6 +215,9 @@ class ListingHandler(object):
     IMMEDIATE = 1
     ALL = 2
 
+    # relations resolved in bulk for all listings returned by get_listings
+    PREFETCH_CACHED = ('publishable__photo', 'publishable__source')
+
     @classmethod
     def regenerate(cls, today=None):
         pass
@@ -178,6 +253,22 @@ class ListingHandler(object):
     def get_listing(self, i):
         return self.get_listings(i, i + 1)[0]
 
+    def get_page(self, offset=0, count=10):
+        """
+        Return ``count`` listings starting at ``offset`` along with the total
+        number of listings. Override if the handler can get both at once.
+        """
+        return self.get_listings(offset, count), self.count()
+
+    def get_listings_after(self, key, count=10, reverse=False):
+        """
+        Return ``count`` listings following the listing identified by
+        ``key`` - a ``(publish_from, id)`` tuple - or preceding it if
+        ``reverse`` is set. Returns ``None`` if the handler cannot seek,
+        callers should then fall back to ``get_listings``.
+        """
+        return None
+
     def count(self):
         raise NotImplementedError
 
@@ -196,30 +287,35 @@ def get_listings_key(self, category=None, children=ListingHandler.NONE, count=10
     )
 
 
-class ListingManager(models.Manager):
-    def clean_listings(self):
-        """
-        Method that cleans the Listing model by deleting all listings that are no longer valid.
-        Should be run periodicaly to purge the DB from unneeded data.
-        """
-        self.filter(publish_to__lt=timezone.now()).delete()
+def get_listings_after_key(self, key, category=None, children=ListingHandler.NONE, count=10, reverse=False, content_types=[], date_range=(), exclude=None):
+    c = category and category.id or ''
+
+    return 'core.get_listings_after:%s:%d:%s:%d:%d:%d:%d:%s:%s' % (
+            key[0].isoformat(), key[1], c, count, reverse, children, exclude.id if exclude else 0,
+            ','.join(map(lambda ct: str(ct.pk), content_types)),
+            ','.join(map(lambda d: d.strftime('%Y%m%d'), date_range)),
+    )
 
-    def get_query_set(self, *args, **kwargs):
-        # get all the fields you typically need to render listing
-        qset = super(ListingManager, self).get_query_set(*args, **kwargs).select_related(
-                'publishable',
-                'publishable__category',
-            )
-        return qset
+
+class BaseListingManager(models.Manager):
+    """
+    Selection of live listings shared by ``Listing`` and its denormalized
+    copy ``ListingFeedItem``. The models must have ``publishable``,
+    ``category``, ``publish_from`` and ``publish_to`` fields.
+    """
+    # lookups of the publishable's published flag and content type
+    published_lookup = 'publishable__published'
+    content_type_lookup = 'publishable__content_type__in'
 
     def get_listing_queryset(self, category=None, children=ListingHandler.NONE, content_types=[], date_range=(), exclude=None, **kwargs):
         # give the database some chance to cache this query
         now = timezone.now().replace(second=0, microsecond=0)
 
+        kwargs[self.published_lookup] = True
         if date_range:
-            qset = self.filter(publish_from__range=date_range, publishable__published=True, **kwargs)
+            qset = self.filter(publish_from__range=date_range, **kwargs)
         else:
-            qset = self.filter(publish_from__lte=now, publishable__published=True, **kwargs)
+            qset = self.filter(publish_from__lte=now, **kwargs)
 
         if category:
             if children == ListingHandler.NONE:
@@ -227,32 +323,114 @@ class ListingManager(models.Manager):
                 qset = qset.filter(category=category)
             elif children == ListingHandler.IMMEDIATE:
                 # this category and its children
-                qset = qset.filter(models.Q(category__tree_parent=category) | models.Q(category=category))
-
-                for c in category.get_children():
-                    if not c.app_data.ella.propagate_listings:
-                        qset = qset.exclude(category=c)
+                qset = qset.filter(category__in=self._get_descendants(category, max_depth=1))
 
             elif children == ListingHandler.ALL:
                 # this category and all its descendants
-                qset = qset.filter(category__tree_path__startswith=category.tree_path, category__site=category.site_id)
-
-                for c in category.get_children(True):
-                    if not c.app_data.ella.propagate_listings:
-                        qset = qset.exclude(category__tree_path__startswith=c.tree_path)
+                qset = qset.filter(category__in=self._get_descendants(category))
 
             else:
                 raise AttributeError('Invalid children value (%s) - should be one of (%s, %s, %s)' % (children, self.NONE, self.IMMEDIATE, self.ALL))
 
         # filtering based on Model classes
         if content_types:
-            qset = qset.filter(publishable__content_type__in=content_types)
+            qset = qset.filter(**{self.content_type_lookup: content_types})
 
         # we were asked to omit certain Publishable
         if exclude:
             qset = qset.exclude(publishable=exclude)
 
-        return qset.exclude(publish_to__lt=now).order_by('-publish_from')
+        qset = qset.exclude(publish_to__lt=now)
+
+        # with children, one publishable can be listed in several categories
+        if category and children != ListingHandler.NONE:
+            qset = self._distinct_publishables(qset, category)
+
+        return qset.order_by('-publish_from', '-pk')
+
+    def get_listings_after(self, key, category=None, children=ListingHandler.NONE, count=10, reverse=False, content_types=[], date_range=(), exclude=None):
+        """
+        Return ``count`` listings following the listing identified by
+        ``key`` - a ``(publish_from, id)`` tuple - in the ordering of
+        ``get_listing_queryset`` or preceding it if ``reverse`` is set.
+        """
+        qset = self.get_listing_queryset(category, children, content_types, date_range, exclude)
+
+        # seek using the (publish_from, id) ordering of the listings
+        publish_from, pk = key
+        if reverse:
+            qset = qset.filter(
+                    models.Q(publish_from__gt=publish_from) |
+                    models.Q(publish_from=publish_from, pk__gt=pk)
+                ).order_by('publish_from', 'pk')
+        else:
+            qset = qset.filter(
+                    models.Q(publish_from__lt=publish_from) |
+                    models.Q(publish_from=publish_from, pk__lt=pk)
+                )
+
+        listings = list(qset[:count])
+        if reverse:
+            listings.reverse()
+        return listings
+
+    def _get_descendants(self, category, max_depth=None):
+        """
+        Ids of ``category`` and its descendants propagating their listings
+        to it, as a subquery over ``CategoryClosure``.
+        """
+        CategoryClosure = get_model('core', 'categoryclosure')
+        qset = CategoryClosure.objects.filter(ancestor=category, propagates=True)
+        if max_depth is not None:
+            qset = qset.filter(depth__lte=max_depth)
+        return qset.values('descendant')
+
+    def _distinct_publishables(self, qset, category):
+        """
+        Only keep the most recent listing of every publishable in ``qset``
+        (preferring the one in ``category`` itself) using a correlated
+        subquery so that the result can be sliced and counted in a single
+        query.
+        """
+        qn = connections[qset.db].ops.quote_name
+        opts = self.model._meta
+        inner = qset.order_by().values_list('pk', flat=True)
+        inner.query.bump_prefix()
+        alias = qn(inner.query.tables[0])
+        column = lambda name: '%s.%s' % (alias, qn(opts.get_field(name).column))
+
+        inner.query.add_extra(None, None, ['%s = %s.%s' % (
+                column('publishable'), qn(opts.db_table), qn(opts.get_field('publishable').column)
+            )], None, None, None)
+        sql, params = inner.query.sql_with_params()
+        sql += ' ORDER BY %s DESC, CASE WHEN %s = %%s THEN 0 ELSE 1 END, %s DESC LIMIT 1' % (
+            column('publish_from'), column('category'), column(opts.pk.name))
+
+        return qset.extra(
+            where=['%s.%s = (%s)' % (qn(opts.db_table), qn(opts.pk.column), sql)],
+            params=tuple(params) + (category.pk, )
+        )
+
+
+class ListingManager(BaseListingManager):
+    def clean_listings(self):
+        """
+        Method that cleans the Listing model by deleting all listings that are no longer valid.
+        Should be run periodicaly to purge the DB from unneeded data.
+        """
+        self.filter(publish_to__lt=timezone.now()).delete()
+
+    def get_query_set(self, *args, **kwargs):
+        # get all the fields you typically need to render listing
+        qset = super(ListingManager, self).get_query_set(*args, **kwargs).select_related(
+                'publishable',
+                'publishable__category',
+            )
+        return qset
+
+    @cache_this(get_listings_after_key)
+    def get_listings_after(self, key, category=None, children=ListingHandler.NONE, count=10, reverse=False, content_types=[], date_range=(), exclude=None):
+        return super(ListingManager, self).get_listings_after(key, category, children, count, reverse, content_types, date_range, exclude)
 
     @cache_this(get_listings_key)
     def get_listing(self, category=None, children=ListingHandler.NONE, count=10, offset=0, content_types=[], date_range=(), exclude=None, **kwargs):
@@ -281,29 +459,8 @@ class ListingManager(models.Manager):
         if children == ListingHandler.NONE:
             return qset[offset:limit]
 
-        seen = set()
-        out = []
-        while len(out) < count:
-            skip = 0
-            # 2 i a reasonable value for padding, wouldn't you say dear Watson?
-            for l in qset[offset:limit + 2]:
-                if l.publishable_id not in seen:
-                    seen.add(l.publishable_id)
-                    out.append(l)
-                    if len(out) == count:
-                        break
-                else:
-                    skip += 1
-
-            # no enough skipped, or not enough listings to work with, no need for another try
-            if skip <= 2 or (len(out) + skip) < (count + 2):
-                break
-
-            # get another page to fill in the gaps
-            offset += count
-            limit += count
-
-        return out
+        # duplicates are removed by get_listing_queryset
+        return list(qset[offset:limit])
 
     def get_listing_handler(self, source, fallback=True):
         if not hasattr(self, '_listing_handlers'):
@@ -333,8 +490,39 @@ class ListingManager(models.Manager):
         )
 
 
+class ListingFeedItemManager(BaseListingManager):
+    published_lookup = 'published'
+    content_type_lookup = 'content_type__in'
+
+    def refresh(self, listings):
+        """
+        Recreate the feed items of ``listings`` from the current state of
+        the listings, their publishables and categories.
+        """
+        items = []
+        for l in listings:
+            p = l.publishable
+            items.append(self.model(
+                listing_id=l.pk,
+                publishable_id=p.pk,
+                content_type_id=p.content_type_id,
+                category_id=l.category_id,
+                category_path=l.category.tree_path,
+                title=p.title,
+                url=p.get_absolute_url(),
+                photo_id=p.photo_id,
+                published=p.published,
+                publish_from=l.publish_from,
+                publish_to=l.publish_to,
+            ))
+
+        self.filter(listing__in=[l.pk for l in listings]).delete()
+        self.bulk_create(items)
+        return len(items)
+
+
 class ModelListingHandler(ListingHandler):
-    def get_listing(self, i):
+    def _get_queryset(self):
         Listing = get_model('core', 'listing')
         return Listing.objects.get_listing_queryset(
                 self.category,
@@ -342,11 +530,14 @@ class ModelListingHandler(ListingHandler):
                 content_types=self.content_types,
                 date_range=self.date_range,
                 exclude=self.exclude
-            )[i]
+            )
+
+    def get_listing(self, i):
+        return self._get_queryset()[i]
 
     def get_listings(self, offset=0, count=10):
         Listing = get_model('core', 'listing')
-        return Listing.objects.get_listing(
+        listings = Listing.objects.get_listing(
                 self.category,
                 children=self.children,
                 content_types=self.content_types,
@@ -355,16 +546,63 @@ class ModelListingHandler(ListingHandler):
                 count=count,
                 exclude=self.exclude
             )
+        prefetch_cached(listings, *self.PREFETCH_CACHED)
+        return listings
+
+    def get_listings_after(self, key, count=10, reverse=False):
+        Listing = get_model('core', 'listing')
+        listings = Listing.objects.get_listings_after(
+                key,
+                self.category,
+                children=self.children,
+                count=count,
+                reverse=reverse,
+                content_types=self.content_types,
+                date_range=self.date_range,
+                exclude=self.exclude
+            )
+        prefetch_cached(listings, *self.PREFETCH_CACHED)
+        return listings
 
     def count(self):
+        if not hasattr(self, '_count') and core_settings.LISTING_COUNT_TIMEOUT and not (self.date_range or self.exclude):
+            from ella.core.cache.counts import get_listing_count
+            self._count = get_listing_count(self.category, self.children, self.content_types)
         if not hasattr(self, '_count'):
-            Listing = get_model('core', 'listing')
-            self._count = Listing.objects.get_listing_queryset(
+            self._count = self._get_queryset().count()
+        return self._count
+
+
+class FeedListingHandler(ModelListingHandler):
+    """
+    Serves ``ListingFeedItem`` instances straight from the denormalized feed
+    table without touching the publishables. Requires ``USE_LISTING_FEED``.
+    """
+    PREFETCH_CACHED = ()
+
+    def _get_queryset(self):
+        ListingFeedItem = get_model('core', 'listingfeeditem')
+        return ListingFeedItem.objects.get_listing_queryset(
                 self.category,
                 children=self.children,
                 content_types=self.content_types,
                 date_range=self.date_range,
                 exclude=self.exclude
-            ).count()
-        return self._count
+            )
+
+    def get_listings(self, offset=0, count=10):
+        return list(self._get_queryset()[offset:offset + count])
+
+    def get_listings_after(self, key, count=10, reverse=False):
+        ListingFeedItem = get_model('core', 'listingfeeditem')
+        return ListingFeedItem.objects.get_listings_after(
+                key,
+                self.category,
+                children=self.children,
+                count=count,
+                reverse=reverse,
+                content_types=self.content_types,
+                date_range=self.date_range,
+                exclude=self.exclude
+            )
 
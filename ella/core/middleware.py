@@ -9,6 +9,7 @@ from django.core.cache import cache
 from django.utils.cache import get_cache_key, add_never_cache_headers, learn_cache_key
 from django.conf import settings
 from ella.core.conf import core_settings
+from ella.core.cache.utils import enable_identity_map, disable_identity_map
 
 class DoubleRenderMiddleware(object):
 
@@ -47,6 +48,20 @@ class DoubleRenderMiddleware(object):
 
         return response
 
+class IdentityMapMiddleware(object):
+    """
+    Makes ``get_cached_object`` and ``get_cached_objects`` return the same
+    instance for the same object for the rest of the request instead of
+    going to the cache over and over again.
+    """
+    def process_request(self, request):
+        enable_identity_map()
+
+    def process_response(self, request, response):
+        disable_identity_map()
+        return response
+
+
 class CacheMiddleware(DjangoCacheMiddleware):
     def process_request(self, request):
         resp = super(CacheMiddleware, self).process_request(request)
@@ -11,7 +11,7 @@ from app_data import AppDataField
 
 from ella.core.cache import CachedGenericForeignKey, SiteForeignKey, ContentTypeForeignKey, CategoryForeignKey, CachedForeignKey, redis
 from ella.core.conf import core_settings
-from ella.core.managers import CategoryManager, ListingHandler
+from ella.core.managers import CategoryManager, CategoryClosureManager, ListingHandler
 
 if hasattr(settings, 'AUTH_USER_MODEL'):
     User = settings.AUTH_USER_MODEL
@@ -137,7 +137,19 @@ class Category(models.Model):
         else:
             self.tree_path = ''
         Category.objects.clear_cache()
+
+        # the closure only depends on the parent and listing propagation
+        rebuild_closure = True
+        if self.pk:
+            old = Category.objects.filter(pk=self.pk).only('tree_parent', 'app_data')
+            if old:
+                old = old[0]
+                rebuild_closure = old.tree_parent_id != self.tree_parent_id or \
+                    old.app_data.ella.propagate_listings != self.app_data.ella.propagate_listings
+
         super(Category, self).save(**kwargs)
+        if rebuild_closure:
+            CategoryClosure.objects.rebuild(self)
         if old_tree_path != self.tree_path:
             # the tree_path has changed, update children
             children = Category.objects.filter(tree_parent=self)
@@ -199,6 +211,30 @@ class Category(models.Model):
     draw_title.allow_tags = True
 
 
+class CategoryClosure(models.Model):
+    """
+    Precomputed closure of the ``Category`` tree - a row for every category
+    and each of its ancestors including itself. ``propagates`` tells whether
+    listings in ``descendant`` show up in ``ancestor``'s listings including
+    children. Maintained by ``Category.save``.
+    """
+    ancestor = models.ForeignKey(Category, related_name='descendant_set')
+    descendant = models.ForeignKey(Category, related_name='ancestor_set')
+    depth = models.PositiveIntegerField()
+    propagates = models.BooleanField(default=True)
+
+    objects = CategoryClosureManager()
+
+    class Meta:
+        app_label = 'core'
+        unique_together = (('ancestor', 'descendant'),)
+        verbose_name = _('Category closure')
+        verbose_name_plural = _('Category closures')
+
+    def __unicode__(self):
+        return u'%s > %s' % (self.ancestor_id, self.descendant_id)
+
+
 class Dependency(models.Model):
     """
     Captures relations between objects to simplify finding out what other objects
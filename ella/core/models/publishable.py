@@ -14,7 +14,7 @@ from ella.core.cache import CachedGenericForeignKey, \
     CachedForeignKey, ContentTypeForeignKey, CategoryForeignKey
 from ella.core.conf import core_settings
 from ella.core.managers import ListingManager, RelatedManager, \
-    PublishableManager
+    PublishableManager, ListingFeedItemManager
 from ella.core.models.main import Author, Source
 from ella.core.signals import content_published, content_unpublished
 from ella.utils.timezone import now, localize
@@ -279,6 +279,43 @@ class Listing(models.Model):
         return self.get_absolute_url(domain=True)
 
 
+class ListingFeedItem(models.Model):
+    """
+    Denormalized copy of a ``Listing`` holding everything needed to render
+    it in a listing box, so that a page of listings can be served by a single
+    query over one table. Only maintained when ``USE_LISTING_FEED`` is set
+    and served by ``FeedListingHandler``.
+    """
+    listing = models.OneToOneField(Listing, primary_key=True, related_name='feed_item')
+    publishable = CachedForeignKey(Publishable)
+    content_type = ContentTypeForeignKey()
+    category = CategoryForeignKey(db_index=True)
+    category_path = models.CharField(max_length=255)
+
+    title = models.CharField(max_length=255)
+    url = models.CharField(max_length=512)
+    photo = CachedForeignKey('photos.Photo', blank=True, null=True, on_delete=models.SET_NULL)
+
+    published = models.BooleanField()
+    publish_from = models.DateTimeField(db_index=True)
+    publish_to = models.DateTimeField(null=True, blank=True)
+
+    objects = ListingFeedItemManager()
+
+    class Meta:
+        app_label = 'core'
+        # pages of a category ordered by publish_from
+        index_together = (('category', 'publish_from'),)
+        verbose_name = _('Listing feed item')
+        verbose_name_plural = _('Listing feed items')
+
+    def __unicode__(self):
+        return self.title
+
+    def get_absolute_url(self):
+        return self.url
+
+
 class Related(models.Model):
     """
     Related objects - model for recording related ``Publishable`` objects.
@@ -1,5 +1,6 @@
 from django import forms
 from django import template
+from django.core.paginator import InvalidPage
 from django.http import Http404
 from django.utils.translation import ugettext_lazy as _
 
@@ -9,6 +10,8 @@ from ella.core.models import Category, Listing
 from ella.core.managers import ListingHandler
 from ella.core.conf import core_settings
 from ella.core.cache.redis import connect_signals
+from ella.core.cache.counts import connect_signals as connect_count_signals
+from ella.core.listing_feed import connect_signals as connect_feed_signals
 from ella.core.cache.utils import connect_invalidation_signals
 from ella.utils.pagination import FirstPagePaginator
 
@@ -51,11 +54,11 @@ class EllaAppDataContainer(AppDataContainer):
                                        paginate_by,
                                        first_page_count=first_page_count)
 
-        if page_no > paginator.num_pages or page_no < 1:
+        try:
+            return paginator.page(page_no)
+        except InvalidPage:
             raise Http404(_('Invalid page number %r') % page_no)
 
-        return paginator.page(page_no)
-
     @property
     def child_behavior(self):
         if self.child_listings is None:
@@ -71,6 +74,12 @@ connect_signals()
 # connect cache invalidation signals
 connect_invalidation_signals()
 
+# keep the cached listing counts up to date
+connect_count_signals()
+
+# and the denormalized listing feed
+connect_feed_signals()
+
 # add core templatetags to builtin so that you don't have to invoke {% load core %} in every template
 template.add_to_builtins('ella.core.templatetags.core')
 # keep this here for backwards compatibility
@@ -31,7 +31,7 @@ def _do_paginator(context, adjacent_pages, template_name):
         page.paginator.num_pages))
     page_numbers = range(s, min(page.paginator.num_pages, s + 2 * adjacent_pages) + 1)
 
-    return template_name, {
+    context = {
         'query_params': query_params,
         'page': page,
         'results_per_page': page.paginator.per_page,
@@ -39,6 +39,12 @@ def _do_paginator(context, adjacent_pages, template_name):
         'show_first': 1 not in page_numbers,
         'show_last': page.paginator.num_pages not in page_numbers,
     }
+    # link the neighbouring pages with cursors when possible
+    if hasattr(page, 'next_cursor'):
+        context['next_page'] = page.next_cursor() if page.has_next() else None
+        context['previous_page'] = page.previous_cursor() if page.has_previous() else None
+
+    return template_name, context
 
 
 @register.simple_tag(takes_context=True)
@@ -55,7 +61,9 @@ def paginator(context, adjacent_pages=2, template_name=None):
 
     Adds pagination context variables for use in displaying first, adjacent pages and
     last page links in addition to those created by the ``object_list`` generic
-    view.
+    view. ``next_page`` and ``previous_page`` hold the values for the ``p``
+    parameter of the neighbouring pages - cursors where the listings allow it
+    so that walking deep into the archive stays cheap.
 
     Taken from http://www.djangosnippets.org/snippets/73/
 
@@ -17,6 +17,7 @@ from ella.core.conf import core_settings
 from ella.core.signals import object_rendering, object_rendered
 from ella.api import render_as_api
 from ella.utils.timezone import now, localize
+from ella.utils.pagination import get_page_number, is_cursor
 
 __docformat__ = "restructuredtext en"
 
@@ -353,9 +354,12 @@ class ListContentType(EllaCoreView):
         no_home_listings = ella_data.no_home_listings
 
         # pagination
-        page_no = None
-        if 'p' in request.GET and request.GET['p'].isdigit():
-            page_no = int(request.GET['p'])
+        page_no = cursor = None
+        if 'p' in request.GET:
+            page_no = get_page_number(request.GET['p'])
+            # deeper pages are linked using cursors to avoid large offsets
+            if page_no is not None and is_cursor(request.GET['p']):
+                cursor = request.GET['p']
 
         # if we are not on the first page, display a different template
         category_title_page = (page_no is None or (not no_home_listings and page_no == 1)) and not year
@@ -405,7 +409,7 @@ class ListContentType(EllaCoreView):
             return context
 
         # add pagination
-        page = ella_data.get_listings_page(page_no, **kwa)
+        page = ella_data.get_listings_page(cursor or page_no, **kwa)
         context.update({
             'is_paginated': page.has_other_pages(),
             'results_per_page': page.paginator.per_page,
@@ -1,6 +1,81 @@
 from math import ceil
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
 
-from django.core.paginator import Paginator, Page
+from django.core.paginator import Paginator, Page, PageNotAnInteger
+
+from ella.utils.timezone import utc_localize
+
+CURSOR_PREFIX = 'c'
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(number, key, reverse=False):
+    """
+    Encode page ``number`` together with the ``(publish_from, id)`` ``key``
+    of the listing the page starts after (or ends before, if ``reverse``)
+    into an opaque string usable as the ``p`` GET parameter.
+    """
+    publish_from, pk = key
+    value = '%d:%d:%s:%d' % (number, int(reverse), utc_localize(publish_from).strftime(CURSOR_DATE_FORMAT), pk)
+    return CURSOR_PREFIX + urlsafe_b64encode(value).rstrip('=')
+
+
+def is_cursor(value):
+    return isinstance(value, basestring) and value.startswith(CURSOR_PREFIX)
+
+
+def decode_cursor(value):
+    """
+    Return ``(number, key, reverse)`` encoded in ``value`` by
+    ``encode_cursor``, raise ``PageNotAnInteger`` for malformed cursors.
+    """
+    try:
+        value = str(value[len(CURSOR_PREFIX):])
+        value = urlsafe_b64decode(value + '=' * (-len(value) % 4))
+        number, reverse, publish_from, pk = value.split(':')
+        publish_from = utc_localize(datetime.strptime(publish_from, CURSOR_DATE_FORMAT))
+        return int(number), (publish_from, int(pk)), reverse == '1'
+    except (TypeError, ValueError, UnicodeError):
+        raise PageNotAnInteger('Invalid page cursor')
+
+
+def get_page_number(value):
+    """
+    Page number from the ``p`` GET parameter, either a plain number or
+    a cursor. Returns ``None`` for invalid values.
+    """
+    if value.isdigit():
+        return int(value)
+    if is_cursor(value):
+        try:
+            return decode_cursor(value)[0]
+        except PageNotAnInteger:
+            pass
+    return None
+
+
+class CursorPage(Page):
+    """
+    Page that links to its neighbours using cursors so that following the
+    next/previous links costs the same regardless of the page's depth.
+    Falls back to plain page numbers when the listings cannot be keyed.
+    """
+    def _get_cursor(self, number, index, reverse):
+        object_list = list(self.object_list)
+        if number == 1 or not object_list:
+            return number
+        listing = object_list[index]
+        key = (getattr(listing, 'publish_from', None), getattr(listing, 'pk', None))
+        if None in key:
+            return number
+        return encode_cursor(number, key, reverse)
+
+    def next_cursor(self):
+        return self._get_cursor(self.next_page_number(), -1, False)
+
+    def previous_cursor(self):
+        return self._get_cursor(self.previous_page_number(), 0, True)
 
 
 class FirstPagePaginator(Paginator):
@@ -15,13 +90,55 @@ class FirstPagePaginator(Paginator):
                                                  allow_empty_first_page)
         self.first_page_count = first_page_count or per_page
 
-    def page(self, number):
-        number = self.validate_number(number)
+    def _get_bounds(self, number):
         bottom = (number - 2) * self.per_page + self.first_page_count if number > 1 else 0
         top = bottom + (self.first_page_count if number == 1 else self.per_page)
+        return bottom, top
+
+    def page(self, number):
+        if is_cursor(number):
+            return self._seek_page(number)
+
+        object_list = None
+        # fetch the items along with the total count in one go if possible
+        if self._count is None and hasattr(self.object_list, 'get_page'):
+            try:
+                bottom, top = self._get_bounds(int(number))
+            except (TypeError, ValueError):
+                # let validate_number complain
+                pass
+            else:
+                object_list, self._count = self.object_list.get_page(bottom, top - bottom + self.orphans)
+
+        number = self.validate_number(number)
+        bottom, top = self._get_bounds(number)
         if top + self.orphans >= self.count:
             top = self.count
-        return Page(self.object_list[bottom:top], number, self)
+
+        if object_list is None:
+            object_list = self.object_list[bottom:top]
+        else:
+            object_list = object_list[:max(0, top - bottom)]
+        return CursorPage(object_list, number, self)
+
+    def _seek_page(self, cursor):
+        """
+        Return the page identified by ``cursor``, fetching its items by
+        seeking past the listing encoded in it instead of skipping over
+        all the preceding pages.
+        """
+        number, key, reverse = decode_cursor(cursor)
+        number = self.validate_number(number)
+        bottom, top = self._get_bounds(number)
+        if top + self.orphans >= self.count:
+            top = self.count
+
+        object_list = None
+        if hasattr(self.object_list, 'get_listings_after'):
+            object_list = self.object_list.get_listings_after(key, max(0, top - bottom), reverse)
+        if object_list is None:
+            object_list = self.object_list[bottom:top]
+        return CursorPage(object_list, number, self)
 
     def _get_num_pages(self):
         if self._num_pages is None:
@@ -60,6 +60,7 @@ LISTING_HANDLERS = {
 LISTINGS_REDIS = {}
 USE_REDIS_FOR_LISTINGS = True
 REDIS_LISTING_HANDLER = 'redis'
+LISTING_COUNT_TIMEOUT = 60 * 60
 
 DEFAULT_PAGE_ID = 1
 
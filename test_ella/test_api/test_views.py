@@ -17,8 +17,10 @@ class TestCategoryDetail(ViewsTestCase):
                 "category": {"url": "/", "id": 1, "title": u"\u4f60\u597d category"},
                 "listings": {
                     u'current_page': 1,
+                    u'next_page': None,
                     u'num_pages': 1,
                     u'objects': [],
+                    u'previous_page': None,
                     u'per_page': 20,
                     u'total': 0
                 }
@@ -1,7 +1,9 @@
 import time
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
 
 from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
 from ella.core.cache.utils import normalize_key
 from hashlib import md5
 from test_ella.cases import RedisTestCase as TestCase
@@ -9,10 +11,15 @@ from django.test.client import RequestFactory
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 
-from ella.core.cache import utils, redis
-from ella.core.models import Listing, Publishable
+from ella.core.cache import utils, redis, prefetch_cached
+from ella.core.cache.local import LocalCache
+from ella.core.cache.serializers import PickleSerializer, RowSerializer
+from ella.core.cache.benchmark import benchmark_serializers, benchmark_publishables
+from ella.core.conf import core_settings
+from ella.core.models import Listing, Publishable, Source
 from ella.core.views import ListContentType
 from ella.core.managers import ListingHandler
+from ella.core.middleware import IdentityMapMiddleware
 from ella.articles.models import Article
 from ella.utils.timezone import from_timestamp, now
 
@@ -20,12 +27,30 @@ from test_ella.test_core import create_basic_categories, create_and_place_a_publ
         create_and_place_more_publishables, list_all_publishables_in_category_by_hour
 
 from nose import tools
+from redis.connection import Connection
+
+@contextmanager
+def count_round_trips():
+    """Record every command packet sent to redis while in the block."""
+    trips = []
+    send_packed_command = Connection.send_packed_command
+    def counting(self, command):
+        trips.append(command)
+        return send_packed_command(self, command)
+    Connection.send_packed_command = counting
+    try:
+        yield trips
+    finally:
+        Connection.send_packed_command = send_packed_command
+
 
 class CacheTestCase(TestCase):
     def setUp(self):
         self.old_cache = utils.cache
         self.cache = get_cache('locmem://')
+        self.cache.clear()
         utils.cache = self.cache
+        utils.local_cache.clear()
         super(CacheTestCase, self).setUp()
 
     def tearDown(self):
@@ -88,6 +113,356 @@ class TestCacheUtils(CacheTestCase):
             utils._get_key(utils.KEY_PREFIX, ContentType.objects.get_for_model(Article), pk=123)
         )
 
+    def test_get_keys_resolves_versions_same_as_get_key(self):
+        ct_ct = ContentType.objects.get_for_model(ContentType)
+        article_ct = ContentType.objects.get_for_model(Article)
+        self.cache.set(utils._get_key(utils.KEY_PREFIX, article_ct, pk=123, version_key=True), 3)
+        pks = [(ct_ct, 1), (article_ct, 123), (article_ct, 124)]
+
+        tools.assert_equals(
+            [utils._get_key(utils.KEY_PREFIX, ct, pk=pk) for ct, pk in pks],
+            utils._get_keys(utils.KEY_PREFIX, pks)
+        )
+
+    def test_get_many_objects_uses_constant_number_of_cache_calls(self):
+        ct_ct = ContentType.objects.get_for_model(ContentType)
+        site_ct = ContentType.objects.get_for_model(Site)
+        pks = [(ct_ct.id, ct_ct.id), (ct_ct.id, site_ct.id), (site_ct.id, 1)]
+        utils.get_cached_objects(pks)
+
+        utils.cache = CountingCache(self.cache)
+        utils.get_cached_objects(pks)
+        tools.assert_equals(['get_many', 'get_many'], utils.cache.calls)
+
+
+class CountingCache(object):
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.cache, name)
+
+
+class TestLocalCache(CacheTestCase):
+    def setUp(self):
+        super(TestLocalCache, self).setUp()
+        core_settings.CACHE_LOCAL_MODELS = ('sites.site', )
+
+    def tearDown(self):
+        del core_settings.CACHE_LOCAL_MODELS
+        super(TestLocalCache, self).tearDown()
+
+    def test_opted_in_model_is_served_without_fetching_the_object(self):
+        site = utils.get_cached_object(Site, pk=1)
+
+        utils.cache = CountingCache(self.cache)
+        tools.assert_equals(site, utils.get_cached_object(Site, pk=1))
+        tools.assert_equals(site, utils.get_cached_objects([1], Site)[0])
+        # just the version stamps
+        tools.assert_equals(['get', 'get_many'], utils.cache.calls)
+
+    def test_other_models_are_not_stored_locally(self):
+        ct = ContentType.objects.get_for_model(ContentType)
+        utils.get_cached_object(ContentType, pk=ct.pk)
+        tools.assert_equals(0, len(utils.local_cache))
+
+    def test_version_change_bypasses_local_copy(self):
+        site = utils.get_cached_object(Site, pk=1)
+        Site.objects.get(pk=1).save()
+        tools.assert_false(site is utils.get_cached_object(Site, pk=1))
+
+    def test_callers_get_their_own_instances(self):
+        site = utils.get_cached_object(Site, pk=1)
+        site.name = 'changed'
+        tools.assert_not_equals('changed', utils.get_cached_object(Site, pk=1).name)
+
+    def test_local_module_is_not_shadowed(self):
+        import ella.core.cache.local as lc
+        tools.assert_true(lc.LocalCache is LocalCache)
+
+    def test_least_recently_used_item_is_evicted(self):
+        lc = LocalCache(2, 60)
+        lc.set('a', 1)
+        lc.set('b', 2)
+        lc.get('a')
+        lc.set('c', 3)
+        tools.assert_equals({'a': 1, 'c': 3}, lc.get_many(['a', 'b', 'c']))
+
+    def test_expired_items_are_not_returned(self):
+        lc = LocalCache(2, 60)
+        lc.set('a', 1, timeout=-1)
+        tools.assert_equals(None, lc.get('a'))
+
+    def test_zero_timeout_is_not_replaced_by_default(self):
+        lc = LocalCache(2, 60)
+        lc.set_many({'a': 1}, timeout=0)
+        tools.assert_equals(None, lc.get('a'))
+
+
+class TestRowSerializer(CacheTestCase):
+    def setUp(self):
+        super(TestRowSerializer, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        self.serializer = RowSerializer()
+
+    def test_article_survives_roundtrip(self):
+        article = self.serializer.loads(self.serializer.dumps(self.publishable))
+        tools.assert_true(isinstance(article, Article))
+        tools.assert_false(article._state.adding)
+        tools.assert_equals(
+            [getattr(self.publishable, f.attname) for f in Article._meta.fields],
+            [getattr(article, f.attname) for f in Article._meta.fields],
+        )
+
+    def test_category_keeps_app_data(self):
+        self.category.app_data = {'ella': {'propagate_listings': False}}
+        category = self.serializer.loads(self.serializer.dumps(self.category))
+        tools.assert_false(category.app_data.ella.propagate_listings)
+
+    def test_outdated_schema_is_ignored(self):
+        ct_id, version, values = self.serializer.dumps(self.category)
+        tools.assert_equals(None, self.serializer.loads((ct_id, version + 1, values)))
+
+    def test_switching_serializers_only_causes_misses(self):
+        site = Site.objects.get(pk=1)
+        old_serializer = utils.serializer
+        try:
+            for serializer in (PickleSerializer(), self.serializer, PickleSerializer()):
+                utils.serializer = serializer
+                tools.assert_equals(site, utils.get_cached_object(Site, pk=1))
+                tools.assert_equals([site], utils.get_cached_objects([1], Site))
+        finally:
+            utils.serializer = old_serializer
+
+    def test_cached_objects_are_stored_as_rows(self):
+        old_serializer = utils.serializer
+        utils.serializer = self.serializer
+        try:
+            utils.get_cached_object(Publishable, pk=self.publishable.pk)
+            key = utils._get_key(utils.KEY_PREFIX, ContentType.objects.get_for_model(Publishable), pk=self.publishable.pk)
+            tools.assert_true(isinstance(self.cache.get(key), tuple))
+            tools.assert_equals(self.publishable, utils.get_cached_object(Publishable, pk=self.publishable.pk))
+            tools.assert_equals([self.publishable], utils.get_cached_objects([self.publishable.pk], Publishable))
+        finally:
+            utils.serializer = old_serializer
+
+    def test_benchmark_compares_serializers(self):
+        results = benchmark_serializers(number=1)
+        tools.assert_equals(
+            [('articles.article', 'PickleSerializer'), ('articles.article', 'RowSerializer'),
+             ('core.category', 'PickleSerializer'), ('core.category', 'RowSerializer')],
+            [r[:2] for r in results]
+        )
+
+
+class TestIdentityMap(CacheTestCase):
+    def setUp(self):
+        super(TestIdentityMap, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        self.middleware = IdentityMapMiddleware()
+        self.middleware.process_request(None)
+
+    def tearDown(self):
+        self.middleware.process_response(None, None)
+        super(TestIdentityMap, self).tearDown()
+
+    def test_same_instance_is_returned_within_request(self):
+        p = utils.get_cached_object(Publishable, pk=self.publishable.pk)
+
+        utils.cache = CountingCache(self.cache)
+        tools.assert_true(p is utils.get_cached_object(Article, pk=self.publishable.pk))
+        tools.assert_true(p is utils.get_cached_objects([self.publishable.pk], Publishable)[0])
+        tools.assert_equals([], utils.cache.calls)
+
+    def test_objects_from_get_many_are_remembered(self):
+        ct_ct = ContentType.objects.get_for_model(ContentType)
+        site, ct = utils.get_cached_objects([(ct_ct.id, ct_ct.id), (ContentType.objects.get_for_model(Site).id, 1)])[::-1]
+
+        tools.assert_true(site is utils.get_cached_object(Site, pk=1))
+        tools.assert_true(ct is utils.get_cached_object(ContentType, pk=ct_ct.pk))
+
+    def test_saved_object_is_forgotten(self):
+        p = utils.get_cached_object(Publishable, pk=self.publishable.pk)
+        self.publishable.save()
+        tools.assert_false(p is utils.get_cached_object(Publishable, pk=self.publishable.pk))
+
+    def test_objects_are_forgotten_after_request(self):
+        p = utils.get_cached_object(Publishable, pk=self.publishable.pk)
+        self.middleware.process_response(None, None)
+        tools.assert_false(p is utils.get_cached_object(Publishable, pk=self.publishable.pk))
+
+
+class TestPrefetchCached(CacheTestCase):
+    def setUp(self):
+        super(TestPrefetchCached, self).setUp()
+        create_basic_categories(self)
+        create_and_place_more_publishables(self)
+        list_all_publishables_in_category_by_hour(self)
+        self.sources = []
+        for i, p in enumerate(self.publishables):
+            s = Source.objects.create(name='Source %d' % i)
+            p.source = s
+            p.save()
+            self.sources.append(s)
+
+    def test_related_objects_are_fetched_in_bulk(self):
+        listings = list(Listing.objects.order_by('pk'))
+        for l in listings:
+            del l._publishable_cache
+        # content types of publishables, articles and sources
+        self.assertNumQueries(3, lambda: prefetch_cached(listings, 'publishable', 'publishable__source'))
+        self.assertNumQueries(0, lambda: [l.publishable.source for l in listings])
+        tools.assert_equals(self.sources, [l.publishable.source for l in listings])
+        tools.assert_true(isinstance(listings[0].publishable, Article))
+
+    def test_already_resolved_objects_are_kept(self):
+        listings = list(Listing.objects.order_by('pk'))
+        p = listings[0].publishable
+        prefetch_cached(listings, 'publishable')
+        tools.assert_true(p is listings[0].publishable)
+
+    def test_null_relations_are_skipped(self):
+        Publishable.objects.update(source=None)
+        publishables = list(Publishable.objects.order_by('pk'))
+        self.assertNumQueries(0, lambda: prefetch_cached(publishables, 'source'))
+
+
+class TestPublishableTypes(CacheTestCase):
+    def setUp(self):
+        super(TestPublishableTypes, self).setUp()
+        create_basic_categories(self)
+        create_and_place_more_publishables(self)
+        self.pks = [p.pk for p in self.publishables]
+        utils.get_cached_objects(self.pks, Publishable)
+        self.cache.delete_many(utils._get_keys(utils.KEY_PREFIX, [(ContentType.objects.get_for_model(Publishable), pk) for pk in self.pks]))
+
+    def test_known_types_skip_publishable_query(self):
+        with self.assertNumQueries(1):
+            objs = utils.get_cached_objects(self.pks, Publishable)
+        tools.assert_equals(self.publishables, objs)
+
+    def test_types_are_shared_through_cache(self):
+        utils.local_cache.clear()
+        self.assertNumQueries(1, lambda: utils.get_cached_objects(self.pks, Publishable))
+
+    def test_single_publishable_is_fetched_with_known_type(self):
+        with self.assertNumQueries(1):
+            obj = utils.get_cached_object(Publishable, pk=self.pks[0])
+        tools.assert_true(isinstance(obj, Article))
+
+    def test_missing_publishable_raises(self):
+        tools.assert_raises(Publishable.DoesNotExist, utils.get_cached_object, Publishable, pk=1000)
+
+    def test_types_dont_depend_on_local_cache_size(self):
+        core_settings.CACHE_LOCAL_MODELS = ('core.publishable', )
+        old_local_cache, utils.local_cache = utils.local_cache, LocalCache(0, 60)
+        self.cache.clear()
+        try:
+            tools.assert_equals(self.publishables, utils.get_cached_objects(self.pks, Publishable, missing=utils.NONE))
+        finally:
+            utils.local_cache = old_local_cache
+            del core_settings.CACHE_LOCAL_MODELS
+
+    def test_benchmark_counts_queries(self):
+        tools.assert_equals(
+            [('cold', 2), ('types known', 1)],
+            [(r[0], r[3]) for r in benchmark_publishables(number=1)]
+        )
+
+
+class TestLookupByOtherFields(CacheTestCase):
+    def setUp(self):
+        super(TestLookupByOtherFields, self).setUp()
+        self.site = Site.objects.get(pk=1)
+        self.site_ct = ContentType.objects.get_for_model(Site)
+
+    def test_lookup_key_only_references_the_pk(self):
+        utils.get_cached_object(Site, domain=self.site.domain)
+        tools.assert_equals((1, 0), self.cache.get(utils._get_key(utils.KEY_PREFIX, self.site_ct, domain=self.site.domain)))
+        tools.assert_equals(self.site, self.cache.get(utils._get_key(utils.KEY_PREFIX, self.site_ct, pk=1)))
+
+    def test_object_cached_under_lookup_key_by_older_version_is_a_miss(self):
+        self.cache.set(utils._get_key(utils.KEY_PREFIX, self.site_ct, domain=self.site.domain), self.site)
+        tools.assert_equals(self.site, utils.get_cached_object(Site, domain=self.site.domain))
+        tools.assert_equals((1, 0), self.cache.get(utils._get_key(utils.KEY_PREFIX, self.site_ct, domain=self.site.domain)))
+
+    def test_cached_lookup_is_served_without_query(self):
+        utils.get_cached_object(Site, domain=self.site.domain)
+        self.assertNumQueries(0, lambda: utils.get_cached_object(Site, domain=self.site.domain))
+
+    def test_changed_object_is_returned(self):
+        utils.get_cached_object(Site, domain=self.site.domain)
+        self.site.name = 'changed'
+        self.site.save()
+        tools.assert_equals('changed', utils.get_cached_object(Site, domain=self.site.domain).name)
+
+    def test_object_no_longer_matching_is_not_returned(self):
+        domain = self.site.domain
+        utils.get_cached_object(Site, domain=domain)
+        self.site.domain = 'changed.example.com'
+        self.site.save()
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, domain=domain)
+
+
+class TestNegativeCaching(CacheTestCase):
+    def test_missing_object_is_remembered(self):
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100)
+        self.assertNumQueries(0, lambda: tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100))
+
+    def test_missing_object_with_custom_lookup_is_remembered(self):
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, domain='example.org')
+        self.assertNumQueries(0, lambda: tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, domain='example.org'))
+
+    def test_created_object_is_found(self):
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100)
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, domain='example.org')
+        site = Site.objects.create(pk=100, domain='example.org', name='example.org')
+
+        tools.assert_equals(site, utils.get_cached_object(Site, pk=100))
+        tools.assert_equals(site, utils.get_cached_object(Site, domain='example.org'))
+
+    def test_get_many_objects_ignores_tombstones(self):
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100)
+        tools.assert_equals([None], utils.get_cached_objects([100], Site, missing=utils.NONE))
+
+
+class TestCacheThis(CacheTestCase):
+    def setUp(self):
+        super(TestCacheThis, self).setUp()
+        self.calls = []
+
+        @utils.cache_this(lambda: 'cache_this_key', timeout=10)
+        def func():
+            self.calls.append(1)
+            return 'fresh'
+        self.func = func
+
+    def test_result_is_computed_once(self):
+        tools.assert_equals('fresh', self.func())
+        tools.assert_equals('fresh', self.func())
+        tools.assert_equals(1, len(self.calls))
+
+    def test_stale_result_is_refreshed(self):
+        self.cache.set('cache_this_key', utils.CachedResult(time.time() - 1, 'stale'))
+        tools.assert_equals('fresh', self.func())
+        tools.assert_equals(1, len(self.calls))
+
+    def test_stale_result_is_served_while_being_refreshed(self):
+        self.cache.set('cache_this_key', utils.CachedResult(time.time() - 1, 'stale'))
+        self.cache.add('cache_this_key:LOCK', 1)
+        tools.assert_equals('stale', self.func())
+        tools.assert_equals(0, len(self.calls))
+
+    def test_values_in_old_format_are_recomputed(self):
+        self.cache.set('cache_this_key', ['a', 'b'])
+        tools.assert_equals('fresh', self.func())
+        tools.assert_equals(1, len(self.calls))
+
+
 class TestCacheInvalidation(CacheTestCase):
     def test_save_invalidates_object(self):
         self.ct = ContentType.objects.get_for_model(ContentType)
@@ -110,6 +485,46 @@ class TestCacheInvalidation(CacheTestCase):
         tools.assert_equals(new_version, initial_version + 1)
 
 
+class TestInvalidationBatch(CacheTestCase):
+    def setUp(self):
+        super(TestInvalidationBatch, self).setUp()
+        self.ct = ContentType.objects.get_for_model(ContentType)
+        self.key = utils._get_key(utils.KEY_PREFIX, self.ct, pk=self.ct.pk, version_key=True)
+
+    def test_object_is_invalidated_once_after_the_batch(self):
+        with utils.invalidation_batch():
+            self.ct.save()
+            self.ct.save()
+            tools.assert_equals(None, self.cache.get(self.key))
+        tools.assert_equals(1, self.cache.get(self.key))
+
+    def test_nested_batches_are_flushed_with_the_outermost(self):
+        with utils.invalidation_batch():
+            with utils.invalidation_batch():
+                self.ct.save()
+            tools.assert_equals(None, self.cache.get(self.key))
+        tools.assert_equals(1, self.cache.get(self.key))
+
+    def test_nothing_is_invalidated_when_the_batch_fails(self):
+        @utils.invalidation_batch()
+        def save():
+            self.ct.save()
+            raise ValueError()
+        tools.assert_raises(ValueError, save)
+        tools.assert_equals(None, self.cache.get(self.key))
+
+    def test_excluded_models_are_ignored(self):
+        site = Site.objects.get(pk=1)
+        key = utils._get_key(utils.KEY_PREFIX, ContentType.objects.get_for_model(Site), pk=1, version_key=True)
+        old_exclude = core_settings.CACHE_INVALIDATION_EXCLUDE
+        core_settings.CACHE_INVALIDATION_EXCLUDE = ('sites.site', )
+        try:
+            site.save()
+        finally:
+            core_settings.CACHE_INVALIDATION_EXCLUDE = old_exclude
+        tools.assert_equals(None, self.cache.get(key))
+
+
 class TestRedisListings(TestCase):
     def setUp(self):
         super(TestRedisListings, self).setUp()
@@ -138,6 +553,16 @@ class TestRedisListings(TestCase):
         tools.assert_equals(['%d:2' % ct_id, '%d:3' % ct_id], redis.client.zrange('listing:c:2', 0, 100))
         tools.assert_equals(['%d:2' % ct_id, '%d:3' % ct_id], redis.client.zrange('listing:d:2', 0, 100))
 
+    def test_keys_are_precomputed_until_category_is_saved(self):
+        p = self.publishables[2]
+        keys = redis.RedisListingHandler.get_keys(self.category_nested, p)
+        tools.assert_true('listing:d:1' in keys)
+        self.assertNumQueries(0, lambda: redis.RedisListingHandler.get_keys(self.category_nested, p))
+
+        self.category_nested.app_data = {'ella': {'propagate_listings': False}}
+        self.category_nested.save()
+        tools.assert_false('listing:d:1' in redis.RedisListingHandler.get_keys(self.category_nested, p))
+
     def test_listing_gets_removed_when_publishable_goes_unpublished(self):
         list_all_publishables_in_category_by_hour(self)
         p = self.publishables[0]
@@ -276,6 +701,80 @@ class TestRedisListings(TestCase):
         tools.assert_equals(l[0].publishable, self.publishables[2])
         tools.assert_equals(l[0].publish_from, dt2)
 
+    def test_filtered_listing_is_materialized_and_reused(self):
+        ct_id = self.publishables[0].content_type_id
+        t1, t2 = time.time()-90, time.time()-100
+        redis.client.zadd('listing:c:2', '%d:1' % ct_id, repr(t1))
+        redis.client.zadd('listing:c:2', '%d:3' % ct_id, repr(t2))
+        redis.client.zadd('listing:ct:%d' % ct_id, '%d:1' % ct_id, repr(t1))
+        redis.client.zadd('listing:ct:%d' % ct_id, '%d:3' % ct_id, repr(t2))
+
+        lh = Listing.objects.get_queryset_wrapper(category=self.category_nested, children=ListingHandler.IMMEDIATE,
+            content_types=[ContentType.objects.get_for_id(ct_id)], source='redis')
+        tools.assert_equals(2, lh.count())
+
+        redis.client.zrem('listing:c:2', '%d:3' % ct_id)
+        tools.assert_equals([self.publishables[0], self.publishables[2]], [l.publishable for l in lh.get_listings(0, 10)])
+
+    def test_materialized_listing_is_refreshed_on_change(self):
+        ct = ContentType.objects.get_for_model(Article)
+        lh = redis.TimeBasedListingHandler(self.category, ListingHandler.ALL, content_types=[ct], exclude=self.publishables[1])
+        p = self.publishables[0]
+        redis.TimeBasedListingHandler.add_publishable(p.category, p, publish_from=p.publish_from)
+        tools.assert_equals(1, lh.count())
+
+        for p in self.publishables[1:]:
+            redis.TimeBasedListingHandler.add_publishable(p.category, p, publish_from=p.publish_from)
+        tools.assert_equals(len(self.publishables) - 1, lh.count())
+
+        redis.TimeBasedListingHandler.remove_publishable(self.publishables[0].category, self.publishables[0])
+        tools.assert_equals(
+            [p.pk for p in self.publishables[2:]],
+            sorted(l.publishable.pk for l in lh.get_listings(0, 10))
+        )
+
+    def test_materialized_listing_depends_only_on_listing_keys(self):
+        ct = ContentType.objects.get_for_model(Article)
+        lh = redis.TimeBasedListingHandler(self.category, ListingHandler.ALL, content_types=[ct])
+        p = self.publishables[0]
+        redis.TimeBasedListingHandler.add_publishable(p.category, p, publish_from=p.publish_from)
+        tools.assert_equals(1, lh.count())
+        tools.assert_true(redis.client.exists('listing:d:1:deps'))
+        tools.assert_false(redis.client.exists('listing:ct:%d:deps' % ct.pk))
+
+        p = self.publishables[1]
+        pipe = redis.TimeBasedListingHandler.add_publishable(p.category, p, publish_from=p.publish_from, commit=False)
+        tools.assert_equals([], [args[0] for args, options in pipe.command_stack if args[0].startswith('EVAL')])
+        redis.TimeBasedListingHandler.execute(pipe)
+        tools.assert_equals(2, lh.count())
+
+    def test_materialized_results_are_refreshed_with_a_single_lookup(self):
+        ct = ContentType.objects.get_for_model(Article)
+        lh = redis.TimeBasedListingHandler(self.category, ListingHandler.ALL, content_types=[ct])
+        p = self.publishables[0]
+        redis.TimeBasedListingHandler.add_publishable(p.category, p, publish_from=p.publish_from)
+        tools.assert_equals(1, lh.count())
+
+        pipe = redis.client.pipeline()
+        for p in self.publishables[1:]:
+            redis.TimeBasedListingHandler.add_publishable(p.category, p, publish_from=p.publish_from, pipe=pipe, commit=False)
+        with count_round_trips() as trips:
+            redis.TimeBasedListingHandler.execute(pipe)
+        # lookup of :deps, check of the loaded script and the pipeline itself
+        tools.assert_equals(3, len(trips))
+        tools.assert_equals(len(self.publishables), lh.count())
+
+    def test_get_page_returns_listings_with_total(self):
+        ct_id = self.publishables[0].content_type_id
+        t1, t2 = time.time()-90, time.time()-100
+        redis.client.zadd('listing:c:2', '%d:1' % ct_id, repr(t1))
+        redis.client.zadd('listing:c:2', '%d:3' % ct_id, repr(t2))
+
+        lh = Listing.objects.get_queryset_wrapper(category=self.category_nested, children=ListingHandler.IMMEDIATE, source='redis')
+        listings, total = lh.get_page(1, 10)
+        tools.assert_equals(2, total)
+        tools.assert_equals([self.publishables[2]], [l.publishable for l in listings])
+
     def test_redis_listing_handler_used_from_view_when_requested(self):
         ct_id = self.publishables[0].content_type_id
         t1, t2 = time.time()-90, time.time()-100
@@ -335,6 +834,52 @@ class TestRedisListings(TestCase):
             )
 
 
+    def test_exclude_is_applied_without_copying_the_listing(self):
+        list_all_publishables_in_category_by_hour(self)
+        keys = set(redis.client.keys())
+
+        for excluded in self.publishables:
+            lh = redis.TimeBasedListingHandler(self.category, ListingHandler.ALL, exclude=excluded)
+            expected = [l.publishable for l in self.listings if l.publishable != excluded]
+            tools.assert_equals(len(expected), lh.count())
+            for offset, count in [(0, 10), (0, 1), (1, 1), (1, 2), (2, 3)]:
+                tools.assert_equals(
+                    expected[offset:offset + count],
+                    [l.publishable for l in lh.get_listings(offset=offset, count=count)]
+                )
+        tools.assert_equals(keys, set(redis.client.keys()))
+
+    def test_time_based_lh_date_range(self):
+        list_all_publishables_in_category_by_hour(self)
+        start = self.listings[-2].publish_from
+        lh = redis.TimeBasedListingHandler(self.category, ListingHandler.ALL,
+            date_range=(start, start + timedelta(seconds=3600)))
+
+        tools.assert_equals(2, lh.count())
+        tools.assert_equals(
+            [l.publishable for l in self.listings[-3:-1]],
+            [l.publishable for l in lh.get_listings()]
+        )
+
+    def test_scored_lh_date_range_uses_time_index(self):
+        list_all_publishables_in_category_by_hour(self)
+        for score, l in enumerate(self.listings):
+            ScoredLH.add_publishable(l.category, l.publishable, score, publish_from=l.publish_from)
+        start = self.listings[-2].publish_from
+        lh = ScoredLH(self.category, ListingHandler.ALL,
+            date_range=(start, start + timedelta(seconds=3600)))
+
+        tools.assert_equals(2, lh.count())
+        tools.assert_equals(
+            [self.listings[-2].publishable, self.listings[-3].publishable],
+            [l.publishable for l in lh.get_listings()]
+        )
+
+
+class ScoredLH(redis.RedisListingHandler):
+    PREFIX = 'scored'
+
+
 class TestAuthorLH(TestCase):
     def setUp(self):
         from ella.core.models import Author
@@ -376,6 +921,40 @@ class TestAuthorLH(TestCase):
         tools.assert_equals(['%d:1' % ct_id, '%d:2' % ct_id, '%d:3' % ct_id],
                             redis.client.zrange('listing:a:1', 0, 100))
 
+    def test_rebuild_recreates_all_keys_from_database(self):
+        list_all_publishables_in_category_by_hour(self)
+        expected = dict((k, redis.client.zrange(k, 0, -1, withscores=True)) for k in redis.client.keys())
+
+        redis.client.zrem('listing:d:1', redis.client.zrange('listing:d:1', 0, 0)[0])
+        redis.client.delete('listing:a:%d' % self.author.pk)
+        redis.client.zadd('listing:c:42', '1:1', 1)
+
+        tools.assert_equals(len(expected), redis.rebuild_listings(chunk_size=2))
+        tools.assert_equals(expected, dict((k, redis.client.zrange(k, 0, -1, withscores=True)) for k in redis.client.keys()))
+
+    def test_scan_keys_walks_all_pages(self):
+        list_all_publishables_in_category_by_hour(self)
+        tools.assert_equals(set(redis.client.keys('listing:*')), set(redis._scan_keys('listing:*', count=1)))
+
+    def test_check_reports_and_repairs_differences(self):
+        list_all_publishables_in_category_by_hour(self)
+        expected = dict((k, redis.client.zrange(k, 0, -1, withscores=True)) for k in redis.client.keys())
+        ct_id = self.publishables[0].content_type_id
+
+        tools.assert_equals([], redis.check_listings())
+
+        redis.client.zrem('listing:d:1', '%d:1' % ct_id)
+        redis.client.zadd('listing:c:1', '%d:1' % ct_id, 1)
+        redis.client.zadd('listing:c:42', '1:1', 1)
+        tools.assert_equals([
+                ('listing:c:1', [], [], ['%d:1' % ct_id]),
+                ('listing:c:42', [], ['1:1'], []),
+                ('listing:d:1', ['%d:1' % ct_id], [], []),
+            ],
+            redis.check_listings(chunk_size=2, repair=True)
+        )
+        tools.assert_equals(expected, dict((k, redis.client.zrange(k, 0, -1, withscores=True)) for k in redis.client.keys()))
+
     def test_not_in_zsets_when_no_listings_present(self):
         ct_id = self.publishables[0].content_type_id
         tools.ok_('%d:1' % ct_id not in redis.client.zrange('listing:a:1', 0, 100))
@@ -434,6 +1013,7 @@ class SlidingLH(redis.SlidingListingHandler):
 class TestSlidingListings(TestCase):
     def setUp(self):
         super(TestSlidingListings, self).setUp()
+        SlidingLH._registered.clear()
         create_basic_categories(self)
         create_and_place_more_publishables(self)
         self.ct_id = self.publishables[0].content_type_id
@@ -452,10 +1032,88 @@ class TestSlidingListings(TestCase):
             'sliding:d:1',
             'sliding:ct:%s' % self.ct_id,
         ]
-        expected = expected_base + [k + ':' + day for k in expected_base] + ['sliding:KEYS', 'sliding:WINDOWS']
+        expected_time = [k.replace('sliding:', 'sliding:time:') for k in expected_base]
+        expected = expected_base + [k + ':' + day for k in expected_base] + expected_time + ['sliding:KEYS', 'sliding:WINDOWS']
         tools.assert_equals(set(expected), set(redis.client.keys(SlidingLH.PREFIX + '*')))
         tools.assert_equals(redis.client.zrange('sliding:d:1', 0, -1, withscores=True), redis.client.zrange('sliding:d:1' + ':' + day, 0, -1, withscores=True))
 
+    def test_keys_are_registered_within_callers_pipeline_once_a_day(self):
+        pipe = redis.client.pipeline()
+        SlidingLH.incr_score(self.category, self.publishables[0], pipe=pipe, commit=False)
+        tools.assert_false(redis.client.exists('sliding:KEYS'))
+        SlidingLH.execute(pipe)
+        tools.assert_true(redis.client.exists('sliding:KEYS'))
+
+        pipe = redis.client.pipeline()
+        SlidingLH.incr_score(self.category, self.publishables[0], pipe=pipe, commit=False)
+        tools.assert_equals(
+            ['ZINCRBY'] * 8,
+            [args[0] for args, options in pipe.command_stack]
+        )
+
+    def test_keys_are_not_remembered_until_the_pipeline_is_executed(self):
+        pipe = redis.client.pipeline()
+        SlidingLH.incr_score(self.category, self.publishables[0], pipe=pipe, commit=False)
+
+        pipe = redis.client.pipeline()
+        SlidingLH.incr_score(self.category, self.publishables[0], pipe=pipe, commit=False)
+        tools.assert_equals(
+            ['SADD', 'ZADD'] + ['ZINCRBY'] * 8,
+            [args[0] for args, options in pipe.command_stack]
+        )
+
+    def test_hit_counter_flushes_aggregated_hits(self):
+        counter = redis.HitCounter(SlidingLH, 60, 10)
+        counter.hit(self.category, self.publishables[0])
+        counter.hit(self.category, self.publishables[0])
+        tools.assert_false(redis.client.exists('sliding:1'))
+
+        counter.flush()
+        tools.assert_equals([('%s:%s' % (self.ct_id, self.publishables[0].pk), 2.0)], redis.client.zrange('sliding:1', 0, -1, withscores=True))
+
+    def test_hit_counter_flushes_when_full(self):
+        counter = redis.HitCounter(SlidingLH, 60, 2)
+        counter.hit(self.category, self.publishables[0])
+        counter.hit(self.category, self.publishables[1])
+        tools.assert_equals(2, redis.client.zcard('sliding:d:1'))
+
+    def test_hit_counter_flushes_after_interval(self):
+        counter = redis.HitCounter(SlidingLH, 0.01, 10)
+        counter.hit(self.category, self.publishables[0])
+        time.sleep(0.1)
+        tools.assert_equals(1, redis.client.zcard('sliding:1'))
+
+    def test_incr_score_is_a_single_round_trip(self):
+        SlidingLH.incr_score(self.category, self.publishables[0])
+        with count_round_trips() as trips:
+            SlidingLH.incr_score(self.category, self.publishables[0])
+        tools.assert_equals(1, len(trips))
+
+    def test_hit_counter_flush_is_a_single_round_trip(self):
+        counter = redis.HitCounter(SlidingLH, 60, 10)
+        for p in self.publishables[:3]:
+            counter.hit(p.category, p)
+        SlidingLH.incr_score(self.category, self.publishables[0])
+        with count_round_trips() as trips:
+            counter.flush()
+        tools.assert_equals(1, len(trips))
+        tools.assert_equals(3, redis.client.zcard('sliding:d:1'))
+
+    def test_hit_counter_requires_a_redis_handler_scored_by_hits(self):
+        old_handler = core_settings.HIT_COUNTER_HANDLER
+        Listing.objects.get_listing_handler('default')
+        Listing.objects._listing_handlers['sliding'] = SlidingLH
+        try:
+            core_settings.HIT_COUNTER_HANDLER = 'sliding'
+            tools.assert_equals(SlidingLH, redis.get_hit_counter_handler())
+
+            for name in ('missing', 'default', 'redis'):
+                core_settings.HIT_COUNTER_HANDLER = name
+                tools.assert_raises(ImproperlyConfigured, redis.get_hit_counter_handler)
+        finally:
+            core_settings.HIT_COUNTER_HANDLER = old_handler
+            del Listing.objects._listing_handlers['sliding']
+
     def test_slide_windows_regenerates_aggregates(self):
         SlidingLH.add_publishable(self.category, self.publishables[0], 10)
         # register the keys that should exist
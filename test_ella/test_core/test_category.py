@@ -6,7 +6,7 @@ from nose import tools
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 
-from ella.core.models import Category
+from ella.core.models import Category, CategoryClosure
 
 from test_ella.test_core import create_basic_categories
 
@@ -80,3 +80,80 @@ class TestCategory(TestCase):
         url = reverse('category_detail', args=(self.category_nested.tree_path, ))
         tools.assert_equals(url, self.category_nested.get_absolute_url())
 
+
+class TestCategoryClosure(TestCase):
+    def setUp(self):
+        super(TestCategoryClosure, self).setUp()
+        create_basic_categories(self)
+
+    def get_closure(self, category):
+        return sorted(CategoryClosure.objects.filter(descendant=category).values_list('ancestor', 'depth', 'propagates'))
+
+    def test_category_is_linked_to_all_its_ancestors(self):
+        tools.assert_equals([
+                (self.category.pk, 2, True),
+                (self.category_nested.pk, 1, True),
+                (self.category_nested_second.pk, 0, True),
+            ], self.get_closure(self.category_nested_second))
+
+    def test_propagation_change_updates_descendants(self):
+        self.category_nested.app_data = {'ella': {'propagate_listings': False}}
+        self.category_nested.save()
+        tools.assert_equals([
+                (self.category.pk, 2, False),
+                (self.category_nested.pk, 1, True),
+                (self.category_nested_second.pk, 0, True),
+            ], self.get_closure(self.category_nested_second))
+
+    def test_moved_category_is_relinked(self):
+        self.category_nested_second.tree_parent = self.category
+        self.category_nested_second.save()
+        tools.assert_equals([
+                (self.category.pk, 1, True),
+                (self.category_nested_second.pk, 0, True),
+            ], self.get_closure(self.category_nested_second))
+        tools.assert_equals([self.category_nested.pk], list(CategoryClosure.objects.filter(ancestor=self.category_nested).values_list('descendant', flat=True)))
+
+
+    def test_closure_is_kept_when_tree_doesnt_change(self):
+        rows = sorted(CategoryClosure.objects.values_list('pk', flat=True))
+        self.category_nested.title = 'Other title'
+        self.category_nested.save()
+        tools.assert_equals(rows, sorted(CategoryClosure.objects.values_list('pk', flat=True)))
+
+    def test_closure_version_is_read_from_shared_cache_once_in_a_while(self):
+        from ella.core import managers
+        class CountingCache(object):
+            reads = []
+            def get(self, key):
+                self.reads.append(key)
+        old_cache = managers.cache
+        managers.cache = CountingCache()
+        try:
+            CategoryClosure.objects._version.clear()
+            CategoryClosure.objects.get_propagated(self.category_nested_second)
+            with self.assertNumQueries(0):
+                CategoryClosure.objects.get_propagated(self.category_nested_second)
+            CategoryClosure.objects.get_propagated(self.category_nested)
+            tools.assert_equals([CategoryClosure.objects.VERSION_KEY], managers.cache.reads)
+        finally:
+            managers.cache = old_cache
+
+    def test_propagated_ancestors_are_reloaded_when_any_process_rebuilds_the_closure(self):
+        from django.core.cache import get_cache
+        from ella.core import managers
+        old_cache = managers.cache
+        managers.cache = get_cache('locmem://')
+        try:
+            tools.assert_equals([self.category_nested.pk, self.category.pk], CategoryClosure.objects.get_propagated(self.category_nested_second))
+
+            # another process changes the tree
+            CategoryClosure.objects.filter(descendant=self.category_nested_second, ancestor=self.category).update(propagates=False)
+            managers.cache.set(CategoryClosure.objects.VERSION_KEY, 1)
+            tools.assert_equals([self.category_nested.pk, self.category.pk], CategoryClosure.objects.get_propagated(self.category_nested_second))
+
+            # noticed once the local version expires
+            CategoryClosure.objects._version.clear()
+            tools.assert_equals([self.category_nested.pk], CategoryClosure.objects.get_propagated(self.category_nested_second))
+        finally:
+            managers.cache = old_cache
@@ -3,11 +3,18 @@ from datetime import timedelta
 
 from test_ella.cases import RedisTestCase as TestCase
 
+from django.core.cache import get_cache
+from django.db.models.signals import pre_save, post_save
+
 from nose import tools
 
-from ella.core.models import Listing, Category
-from ella.core.managers import ListingHandler
+from ella.core.models import Listing, Category, ListingFeedItem
+from ella.core.managers import ListingHandler, FeedListingHandler
+from ella.core import listing_feed
+from ella.core.cache import counts
 from ella.utils.timezone import now
+from ella.utils.pagination import FirstPagePaginator
+from ella.utils.test_helpers import default_time
 
 from test_ella.test_core import create_basic_categories, create_and_place_a_publishable, \
         create_and_place_more_publishables, list_all_publishables_in_category_by_hour
@@ -81,6 +88,18 @@ class TestListing(TestCase):
         tools.assert_equals(len(self.listings), len(l))
         tools.assert_equals(listing, l[0])
 
+    def test_duplicates_are_removed_in_a_single_query(self):
+        for c in (self.category_nested, self.category_nested_second):
+            list_all_publishables_in_category_by_hour(self, category=c)
+        qset = Listing.objects.get_listing_queryset(category=self.category, children=ListingHandler.ALL)
+
+        tools.assert_equals(len(self.publishables), qset.count())
+        publishables = []
+        for offset in xrange(0, len(self.publishables), 2):
+            with self.assertNumQueries(1):
+                publishables.extend(l.publishable_id for l in qset[offset:offset + 2])
+        tools.assert_equals(sorted(p.pk for p in self.publishables), sorted(publishables))
+
     def test_get_listing_IMMEDIATE_without_limited_categories(self):
         self.category_nested.app_data = {'ella': {'propagate_listings': False}}
         self.category_nested.save()
@@ -118,3 +137,215 @@ class TestListing(TestCase):
         l = lh[0]
         tools.assert_equals(self.listings[0], l)
 
+    def test_seek_returns_listings_following_the_given_one(self):
+        lh = Listing.objects.get_queryset_wrapper(self.category, children=ListingHandler.ALL)
+        l = self.listings[0]
+        tools.assert_equals(self.listings[1:3], lh.get_listings_after((l.publish_from, l.pk), 2))
+
+    def test_seek_in_reverse_returns_listings_preceding_the_given_one(self):
+        lh = Listing.objects.get_queryset_wrapper(self.category, children=ListingHandler.ALL)
+        l = self.listings[2]
+        tools.assert_equals(self.listings[0:2], lh.get_listings_after((l.publish_from, l.pk), 2, reverse=True))
+
+    def test_seek_breaks_ties_by_id(self):
+        first, second = self.listings[0], self.listings[1]
+        Listing.objects.filter(pk=first.pk).update(publish_from=second.publish_from)
+        lh = Listing.objects.get_queryset_wrapper(self.category, children=ListingHandler.ALL)
+        listings = lh.get_listings(0, 2)
+        tools.assert_equals(sorted([first.pk, second.pk], reverse=True), [l.pk for l in listings])
+        l = listings[0]
+        tools.assert_equals([listings[1]] + self.listings[2:3], lh.get_listings_after((l.publish_from, l.pk), 2))
+
+    def test_seek_results_are_cached_per_cursor(self):
+        from ella.core.cache import utils
+        old_cache = utils.cache
+        utils.cache = get_cache('locmem://')
+        try:
+            lh = Listing.objects.get_queryset_wrapper(self.category, children=ListingHandler.ALL)
+            first, second = self.listings[0], self.listings[1]
+            tools.assert_equals(self.listings[1:2], lh.get_listings_after((first.publish_from, first.pk), 1))
+
+            Listing.objects.filter(pk=second.pk).update(publish_from=now() + timedelta(days=1))
+            tools.assert_equals(self.listings[1:2], lh.get_listings_after((first.publish_from, first.pk), 1))
+            tools.assert_equals(self.listings[2:3], lh.get_listings_after((second.publish_from, second.pk), 1))
+        finally:
+            utils.cache = old_cache
+
+    def test_cursor_pages_match_numbered_pages(self):
+        lh = Listing.objects.get_queryset_wrapper(self.category, children=ListingHandler.ALL)
+        paginator = FirstPagePaginator(lh, 1)
+        page = paginator.page(1)
+        tools.assert_equals(self.listings[:1], list(page.object_list))
+        page = paginator.page(page.next_cursor())
+        tools.assert_equals(2, page.number)
+        tools.assert_equals(self.listings[1:2], list(page.object_list))
+        page = paginator.page(page.next_cursor())
+        tools.assert_equals(3, page.number)
+        tools.assert_equals(self.listings[2:3], list(page.object_list))
+        page = paginator.page(page.previous_cursor())
+        tools.assert_equals(2, page.number)
+        tools.assert_equals(self.listings[1:2], list(page.object_list))
+        tools.assert_equals(1, page.previous_cursor())
+
+
+class TestListingCounts(TestCase):
+    def setUp(self):
+        super(TestListingCounts, self).setUp()
+        self.old_cache = counts.cache
+        counts.cache = get_cache('locmem://')
+        counts.cache.clear()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_publishables_in_category_by_hour(self)
+
+    def tearDown(self):
+        counts.cache = self.old_cache
+        super(TestListingCounts, self).tearDown()
+
+    def count(self, category, children=ListingHandler.ALL):
+        return Listing.objects.get_queryset_wrapper(category, children=children).count()
+
+    def test_count_is_kept_in_cache(self):
+        tools.assert_equals(3, self.count(self.category))
+        with self.assertNumQueries(0):
+            tools.assert_equals(3, self.count(self.category))
+
+    def test_new_listing_is_counted_without_recount(self):
+        self.count(self.category)
+        self.count(self.category_nested_second, ListingHandler.NONE)
+        Listing.objects.create(publishable=self.publishable, category=self.category_nested_second, publish_from=default_time)
+        with self.assertNumQueries(0):
+            tools.assert_equals(4, self.count(self.category))
+            tools.assert_equals(2, self.count(self.category_nested_second, ListingHandler.NONE))
+
+    def test_publishable_listed_twice_is_counted_once(self):
+        self.count(self.category)
+        self.count(self.category_nested, ListingHandler.NONE)
+        Listing.objects.create(publishable=self.publishables[2], category=self.category_nested, publish_from=default_time)
+        with self.assertNumQueries(0):
+            tools.assert_equals(3, self.count(self.category))
+            tools.assert_equals(2, self.count(self.category_nested, ListingHandler.NONE))
+
+    def test_every_listing_is_counted_without_children(self):
+        tools.assert_equals(3, self.count(None))
+        Listing.objects.create(publishable=self.publishables[2], category=self.category_nested, publish_from=default_time)
+        with self.assertNumQueries(0):
+            tools.assert_equals(4, self.count(None))
+        tools.assert_equals(4, Listing.objects.get_listing_queryset().count())
+
+        self.publishables[2].delete()
+        with self.assertNumQueries(0):
+            tools.assert_equals(2, self.count(None))
+        tools.assert_equals(2, Listing.objects.get_listing_queryset().count())
+
+    def test_deleted_listing_is_not_counted(self):
+        self.count(self.category)
+        self.listings[0].delete()
+        with self.assertNumQueries(0):
+            tools.assert_equals(2, self.count(self.category))
+
+    def test_unpublished_publishable_is_not_counted(self):
+        self.count(self.category)
+        p = self.publishables[0]
+        p.published = False
+        p.save()
+        with self.assertNumQueries(0):
+            tools.assert_equals(2, self.count(self.category))
+
+    def test_deleted_publishable_is_not_counted_twice(self):
+        p = self.publishables[2]
+        Listing.objects.create(publishable=p, category=self.category_nested, publish_from=default_time)
+        self.count(self.category)
+        p.delete()
+        with self.assertNumQueries(0):
+            tools.assert_equals(2, self.count(self.category))
+        tools.assert_equals(2, Listing.objects.get_listing_queryset(self.category, children=ListingHandler.ALL).count())
+
+
+    def test_repeated_publish_signals_dont_change_the_count(self):
+        from ella.core.management import regenerate_publish_signals
+        self.count(self.category)
+        regenerate_publish_signals()
+        with self.assertNumQueries(0):
+            tools.assert_equals(3, self.count(self.category))
+
+    def test_republished_publishable_is_counted_again(self):
+        self.count(self.category)
+        p = self.publishables[0]
+        p.published = False
+        p.save()
+        p.published = True
+        p.save()
+        with self.assertNumQueries(0):
+            tools.assert_equals(3, self.count(self.category))
+
+    def test_count_expires_when_scheduled_listing_goes_live(self):
+        Listing.objects.create(publishable=self.publishable, category=self.category, publish_from=now() + timedelta(seconds=60))
+        tools.assert_true(counts._get_count_timeout(self.category, ListingHandler.ALL, None) <= 61)
+        tools.assert_equals(3600, counts._get_count_timeout(self.category_nested_second, ListingHandler.NONE, None))
+
+class TestListingFeed(TestCase):
+    def setUp(self):
+        super(TestListingFeed, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_publishables_in_category_by_hour(self)
+        listing_feed.rebuild_feed()
+
+    def tearDown(self):
+        post_save.disconnect(listing_feed.publishable_post_save)
+        super(TestListingFeed, self).tearDown()
+
+    def test_feed_matches_listings(self):
+        lh = FeedListingHandler(self.category, children=ListingHandler.ALL)
+        items = lh.get_listings(0, 10)
+        tools.assert_equals([l.pk for l in self.listings], [i.pk for i in items])
+        tools.assert_equals(
+            [(l.publishable.title, l.get_absolute_url(), l.category.tree_path) for l in self.listings],
+            [(i.title, i.get_absolute_url(), i.category_path) for i in items]
+        )
+
+    def test_page_is_served_by_a_single_query(self):
+        lh = FeedListingHandler(self.category, children=ListingHandler.ALL)
+        with self.assertNumQueries(1):
+            items = lh.get_listings(0, 10)
+            [(i.title, i.url, i.photo_id, i.content_type_id) for i in items]
+
+    def test_unpublished_publishable_is_removed_from_feed(self):
+        post_save.connect(listing_feed.publishable_post_save)
+        p = self.publishables[0]
+        p.published = False
+        p.save()
+        lh = FeedListingHandler(self.category, children=ListingHandler.ALL)
+        tools.assert_equals([l.pk for l in self.listings if l.publishable != p], [i.pk for i in lh.get_listings(0, 10)])
+
+    def test_deleted_listing_is_removed_from_feed(self):
+        self.listings[0].delete()
+        tools.assert_equals(2, ListingFeedItem.objects.count())
+
+    def test_rebuild_replaces_stale_items(self):
+        ListingFeedItem.objects.update(title='stale')
+        tools.assert_equals(3, listing_feed.rebuild_feed(chunk_size=2))
+        tools.assert_equals(
+            sorted(l.publishable.title for l in self.listings),
+            sorted(ListingFeedItem.objects.values_list('title', flat=True))
+        )
+
+    def test_renamed_category_updates_paths_of_its_subtree(self):
+        pre_save.connect(listing_feed.category_pre_save, sender=Category)
+        post_save.connect(listing_feed.category_post_save, sender=Category)
+        try:
+            self.category_nested.slug = 'renamed'
+            self.category_nested.save()
+        finally:
+            pre_save.disconnect(listing_feed.category_pre_save, sender=Category)
+            post_save.disconnect(listing_feed.category_post_save, sender=Category)
+
+        tools.assert_equals(
+            sorted((l.pk, Category.objects.get(pk=l.category_id).tree_path) for l in self.listings),
+            sorted(ListingFeedItem.objects.values_list('listing', 'category_path'))
+        )
+        tools.assert_true(any('renamed' in path for path in ListingFeedItem.objects.values_list('category_path', flat=True)))
+
@@ -1,7 +1,10 @@
 from unittest import TestCase
 
 from nose import tools
-from ella.utils.pagination import FirstPagePaginator
+from django.core.paginator import InvalidPage
+
+from ella.utils.pagination import FirstPagePaginator, encode_cursor, decode_cursor
+from ella.utils.timezone import now
 
 
 OBJECTS = ['1', '2', '3', '4', '5']
@@ -24,3 +27,47 @@ class TestPaginator(TestCase):
 
         tools.assert_equals(p.page(1).object_list, ['1', '2'])
         tools.assert_equals(p.page(2).object_list, ['3', '4'])
+
+
+class PagedList(list):
+    def __init__(self, *args):
+        super(PagedList, self).__init__(*args)
+        self.calls = []
+
+    def get_page(self, offset, count):
+        self.calls.append((offset, count))
+        return self[offset:offset + count], len(self)
+
+    def count(self):
+        raise AssertionError('count() should not be called.')
+
+
+class TestPaginatorWithGetPage(TestCase):
+    def test_page_and_count_are_fetched_together(self):
+        objects = PagedList(OBJECTS)
+        p = FirstPagePaginator(objects, first_page_count=1, per_page=2)
+
+        tools.assert_equals(p.page(2).object_list, ['2', '3'])
+        tools.assert_equals(5, p.count)
+        tools.assert_equals([(1, 2)], objects.calls)
+
+    def test_orphans_are_included_in_last_page(self):
+        objects = PagedList(OBJECTS)
+        p = FirstPagePaginator(objects, per_page=2, orphans=1)
+
+        tools.assert_equals(p.page(2).object_list, ['3', '4', '5'])
+
+
+class TestCursors(TestCase):
+    def test_cursor_survives_roundtrip(self):
+        key = (now(), 42)
+        tools.assert_equals((3, key, True), decode_cursor(encode_cursor(3, key, True)))
+
+    def test_invalid_cursor_raises_invalid_page(self):
+        tools.assert_raises(InvalidPage, decode_cursor, 'cnonsense')
+
+    def test_lists_fall_back_to_offsets(self):
+        p = FirstPagePaginator(OBJECTS, first_page_count=1, per_page=2)
+        page = p.page(encode_cursor(3, (now(), 1)))
+        tools.assert_equals(3, page.number)
+        tools.assert_equals(['4', '5'], page.object_list)